@@ -1,18 +1,152 @@
+#   Bash completion for `wb`.
+#
+#   Names are completed one path segment at a time, like directories. The
+#   configuration is read from `wb -E` once, and re-read only when
+#   WORKBENCH_RC, WORKBENCH_HOME, WORKBENCH_MIRROR or HOME change in the
+#   shell. Entries are read from WORKBENCH_MIRROR, once `wb` has synced
+#   it, rather than from WORKBENCH_HOME. The entries of each directory are
+#   cached in WORKBENCH_CACHE_DIR/complete, and are re-read unless the
+#   cache file is newer than the directory. Filtering by prefix is done in
+#   the shell, so a keypress on a warm cache doesn't spawn any process.
+#
+#   Run `_wb_complete_reset` to force the configuration to be re-read.
+
+_wb_complete_reset () {
+    _wbCompleteKey=""
+}
+
+_wb_complete_config () {
+    #   Sets _wbComplete{Home,Mirror,Extn,Shelf,Cache} from `wb -E`
+    local key="${WORKBENCH_RC-unset}:${WORKBENCH_HOME-unset}"
+    key+=":${WORKBENCH_MIRROR-unset}:${HOME}"
+    [[ "${_wbCompleteKey}" == "${key}" ]] && return 0
+
+    local line
+    local WORKBENCH_HOME WORKBENCH_BENCH_EXTN WORKBENCH_SHELF_FILE
+    local WORKBENCH_CACHE_DIR WORKBENCH_MIRROR
+    while IFS= read -r line; do
+        case "${line}" in
+            WORKBENCH_HOME=*|WORKBENCH_BENCH_EXTN=*|\
+            WORKBENCH_SHELF_FILE=*|WORKBENCH_CACHE_DIR=*|\
+            WORKBENCH_MIRROR=*)
+                eval "${line}";;
+        esac
+    done < <(wb -E 2>/dev/null)
+    [[ -z "${WORKBENCH_HOME}" ]] && return 1
+
+    _wbCompleteHome="${WORKBENCH_HOME}"
+    _wbCompleteMirror="${WORKBENCH_MIRROR}"
+    _wbCompleteExtn="${WORKBENCH_BENCH_EXTN}"
+    _wbCompleteShelf="${WORKBENCH_SHELF_FILE}"
+    _wbCompleteCache="${WORKBENCH_CACHE_DIR}"
+    _wbCompleteKey="${key}"
+}
+
+_wb_complete_entries () {
+    # $1 = directory relative to WORKBENCH_HOME; empty, or ending with '/'
+    #
+    #   Fills `entries` with the subdirectories of $1 as 'name/' and its
+    #   benches as 'name'. Entries whose name starts with a dot, like
+    #   '.git' or '.wbcache', are left out.
+    #
+    local dir="${_wbCompleteHome}/$1"
+    [[ -n "${_wbCompleteMirror}" ]] && [[ -f "${_wbCompleteCache}/mirror" ]] \
+        && dir="${_wbCompleteMirror}/$1"
+    local cacheFile="${_wbCompleteCache}/complete/$1.entries"
+    [[ -d "${dir}" ]] || return 1
+
+    #   Timestamps are coarser than the time it takes to list a directory.
+    #   A cache file written in the same tick as a change isn't trusted.
+    if [[ "${cacheFile}" -nt "${dir}" ]]; then
+        mapfile -t entries < "${cacheFile}"
+        return 0
+    fi
+
+    local path name
+    local dotglob nullglob
+    shopt -q dotglob && dotglob="1"
+    shopt -q nullglob && nullglob="1"
+    shopt -u dotglob
+    shopt -s nullglob
+    for path in "${dir}"*; do
+        name="${path##*/}"
+        if [[ -d "${path}" ]]; then
+            [[ "${path}" == "${_wbCompleteCache}" ]] && continue
+            entries+=("${name}/")
+        elif [[ "${name}" == *".${_wbCompleteExtn}" ]]; then
+            entries+=("${name%.${_wbCompleteExtn}}")
+        fi
+    done
+    [[ -n "${dotglob}" ]] && shopt -s dotglob
+    [[ -z "${nullglob}" ]] && shopt -u nullglob
+
+    [[ -d "${cacheFile%/*}" ]] || mkdir -p "${cacheFile%/*}" 2>/dev/null
+    printf "%s\n" "${entries[@]}" 2>/dev/null > "${cacheFile}"
+    return 0
+}
+
 _wb_completion () {
-    local cur prev
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    local first=1
+    local word
     COMPREPLY=()
-    cur=${COMP_WORDS[COMP_CWORD]}
-    prev=${COMP_WORDS[COMP_CWORD-1]}
-    if [[ $COMP_CWORD -eq 1 ]]; then
-        COMPREPLY=( $(compgen -W "s b a r n -V -E" -- $cur) )
-    elif [[ $COMP_CWORD -eq 2 ]]; then
-        case "$prev" in
-            "s") COMPREPLY=($(compgen -W "$(wb s)" -- $cur));;
-            "b") COMPREPLY=($(compgen -W "$(wb b)" -- $cur));;
-            "a") COMPREPLY=($(compgen -W "$(wb a)" -- $cur));;
-            "r") COMPREPLY=($(compgen -W "$(wb r)" -- $cur));;
-            "n") COMPREPLY=($(compgen -W "$(wb n)" -- $cur));;
-        esac
+    while [[ "${COMP_WORDS[first]}" == "--profile" ]] || \
+          [[ "${COMP_WORDS[first]}" == "--trace" ]]; do
+        [[ ${first} -eq ${COMP_CWORD} ]] && break
+        ((first++))
+    done
+
+    if [[ ${COMP_CWORD} -eq ${first} ]]; then
+        local words=(s b a r n p index compile export snapshot affected
+                     manifest watch symbol -V -E --profile --trace)
+        for word in "${words[@]}"; do
+            [[ "${word}" == "${cur}"* ]] && COMPREPLY+=("${word}")
+        done
+        return 0
+    fi
+
+    local cmd="${COMP_WORDS[first]}"
+    case "${cmd}" in
+        s|b|a|r|n) [[ ${COMP_CWORD} -eq $((first + 1)) ]] || return 0;;
+        symbol) [[ ${COMP_CWORD} -eq $((first + 2)) ]] || return 0;;
+        compile|export|snapshot) ;;
+        p)
+            for word in "${COMP_WORDS[@]:first:COMP_CWORD-first}"; do
+                [[ "${word}" == "--" ]] && return 0
+            done
+            ;;
+        *) return 0;;
+    esac
+    [[ "${cur}" == -* ]] && return 0
+    _wb_complete_config || return 0
+
+    local dir=""
+    local segment="${cur}"
+    if [[ "${cur}" == */* ]]; then
+        dir="${cur%/*}/"
+        segment="${cur##*/}"
+    fi
+    local lookup="${dir}"
+    while [[ "${lookup}" == /* ]]; do lookup="${lookup#/}"; done
+
+    local entries=()
+    _wb_complete_entries "${lookup}" || return 0
+    if [[ "${cmd}" == "s" ]]; then
+        for word in "${entries[@]}"; do
+            [[ "${word}" == "${segment}"*/ ]] && COMPREPLY+=("${dir}${word}")
+        done
+    elif [[ -z "${segment}" ]]; then
+        COMPREPLY=("${entries[@]/#/${dir}}")
+    else
+        for word in "${entries[@]}"; do
+            [[ "${word}" == "${segment}"* ]] && COMPREPLY+=("${dir}${word}")
+        done
+    fi
+    if [[ "${cmd}" == "s" ]] && [[ -z "${cur}" ]] && \
+       [[ -f "${_wbCompleteHome}/${_wbCompleteShelf}" ]]; then
+        COMPREPLY+=("/")
     fi
+    [[ "${COMPREPLY[*]}" == */* ]] && compopt -o nospace 2>/dev/null
+    return 0
 }
 complete -F _wb_completion wb
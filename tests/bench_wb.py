@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Scale benchmarks for WorkBench.
+
+Generates synthetic WORKBENCH_HOMEs and times the commands whose cost
+grows with the tree. Every combination of --benches, --depth,
+--shelf-density and --mode is a scenario. A mode runs the commands with
+one of the opt-in caches turned on.
+
+    tests/bench_wb.py --benches 100,10000 --depth 1,6 -o results.json
+    tests/bench_wb.py --benches 100,10000 --depth 1,6 --compare results.json
+
+Times are in milliseconds. With --compare, a command regresses when its
+--statistic (the fastest run by default) exceeds the baseline's by more
+than --tolerance (a fraction) and --noise-floor (in ms). The exit code is
+1 if anything regressed.
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from os import makedirs
+from os.path import abspath, dirname, join
+
+WB_DIR=abspath(join(dirname(__file__), ".."))
+WB=join(WB_DIR, "wb")
+COMPLETION=join(WB_DIR, "completion", "wb_complete.bash")
+
+EXECUTOR="bash"
+RESULTS_VERSION=2
+
+#   Comparisons of fewer runs than this flap on a busy machine
+MIN_COMPARE_REPEAT=10
+
+SHELF_FILE="wb.shelf"
+BENCH_EXTN="bench"
+
+#   The env each mode runs the commands with
+MODES = {
+    "plain": {},
+    "index": {"WORKBENCH_INDEX": "1"},
+    "compose-cache": {"WORKBENCH_COMPOSE_CACHE": "1"},
+    "snapshot": {"WORKBENCH_SNAPSHOT": "1"},
+    "exec-fd": {"WORKBENCH_EXEC_FD": "1"},
+}
+
+
+# -----------------------------------------------------------------------------
+#
+#   Synthetic WORKBENCH_HOME
+#
+# -----------------------------------------------------------------------------
+
+def bench_names(benches, depth):
+    """
+    Names for `benches` benches, each `depth` levels deep. Directories
+    fan out evenly, so that every level has about the same width.
+    """
+    fanout = max(2, math.ceil(benches ** (1.0 / depth)))
+    names = []
+    for i in range(benches):
+        parts, n = [], i
+        for level in range(depth - 1):
+            parts.append("d{}".format(n % fanout))
+            n //= fanout
+        names.append("/".join(reversed(parts + ["b{}".format(i)])))
+    return sorted(names)
+
+
+def generate_home(home, benches, depth, shelf_density, seed=0):
+    """
+    Creates a WORKBENCH_HOME with a shelf at the root, and at a fraction
+    `shelf_density` of the other directories. Returns the bench names.
+    """
+    rng = random.Random(seed)
+    names = bench_names(benches, depth)
+    dirs = {""}
+    for name in names:
+        parts = name.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            dirs.add("/".join(parts[:i]))
+    for d in sorted(dirs):
+        makedirs(join(home, d), exist_ok=True)
+        if d == "" or rng.random() < shelf_density:
+            with open(join(home, d, SHELF_FILE), "w") as f:
+                f.write("export SHELF_{}=1\n".format(len(d)))
+    for name in names:
+        with open(join(home, "{}.{}".format(name, BENCH_EXTN)), "w") as f:
+            f.write("BENCH_NAME={}\n".format(name))
+    return names
+
+
+# -----------------------------------------------------------------------------
+#
+#   Timing
+#
+# -----------------------------------------------------------------------------
+
+def wb_env(home, user_home, mode="plain"):
+    env = {k: v for k, v in os.environ.items()
+           if not k.startswith("WORKBENCH_")}
+    env.update(HOME=user_home, WORKBENCH_HOME=home)
+    env.update(MODES[mode])
+    return env
+
+
+def time_commands(commands, env, repeat):
+    """
+    Runs each of the labelled `commands` once to fill any cache, then
+    `repeat` times in turn, so that a slow spell of the machine is shared
+    between them. Returns the wall times of the latter in ms by label.
+    """
+    times = {label: [] for label, args in commands}
+    for _ in range(repeat + 1):
+        for label, args in commands:
+            start = time.perf_counter()
+            cp = subprocess.run(args, env=env, cwd=WB_DIR,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE)
+            times[label].append((time.perf_counter() - start) * 1000)
+            if cp.returncode != 0:
+                raise RuntimeError("{} failed: {}".format(
+                    " ".join(args), cp.stderr.decode("utf-8", "replace")))
+    return {label: runs[1:] for label, runs in times.items()}
+
+
+def time_completion(word, env, repeat):
+    """
+    Times completion of `word` for 'wb r' within a single shell, after a
+    warm up keypress. Returns the time of each keypress in ms.
+    """
+    script = "\n".join([
+        'wb () {{ {} {} "$@"; }}'.format(EXECUTOR, WB),
+        'source {}'.format(COMPLETION),
+        'COMP_WORDS=(wb r {}); COMP_CWORD=2'.format(word),
+        '_wb_completion',
+        'for ((i = 0; i < {}; i++)); do'.format(repeat),
+        '    start=${EPOCHREALTIME/./}',
+        '    _wb_completion',
+        '    echo $((${EPOCHREALTIME/./} - start))',
+        'done',
+    ])
+    cp = subprocess.run([EXECUTOR, "-c", script], env=env, check=True,
+                        stdout=subprocess.PIPE)
+    return [int(usec) / 1000 for usec in cp.stdout.decode().split()]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lo, hi = math.floor(k), math.ceil(k)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(times):
+    return dict(
+        runs=len(times),
+        min=round(min(times), 3),
+        mean=round(statistics.mean(times), 3),
+        p50=round(percentile(times, 50), 3),
+        p90=round(percentile(times, 90), 3),
+        p99=round(percentile(times, 99), 3),
+        max=round(max(times), 3),
+    )
+
+
+def run_scenario(benches, depth, shelf_density, mode, repeat, work_dir):
+    home = join(work_dir, "wbhome")
+    user_home = join(work_dir, "home")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    makedirs(user_home)
+    start = time.perf_counter()
+    names = generate_home(home, benches, depth, shelf_density)
+    generate_ms = (time.perf_counter() - start) * 1000
+
+    env = wb_env(home, user_home, mode)
+    bench = names[len(names) // 2]
+    wb = [EXECUTOR, WB]
+    commands = [
+        ("wb b", wb + ["b"]),
+        ("wb s", wb + ["s"]),
+        ("wb a --dump", wb + ["a", "--dump", bench]),
+        ("wb r true", wb + ["r", bench, "true"]),
+    ]
+    results = {label: summarize(runs) for label, runs
+               in time_commands(commands, env, repeat).items()}
+    prefix = bench.rsplit("/", 1)[0] + "/" if "/" in bench else ""
+    results["completion"] = summarize(
+        time_completion(prefix, env, max(repeat, 20)))
+    return dict(benches=benches, depth=depth, shelf_density=shelf_density,
+                mode=mode, generate_ms=round(generate_ms, 3),
+                results=results)
+
+
+# -----------------------------------------------------------------------------
+#
+#   Comparison
+#
+# -----------------------------------------------------------------------------
+
+def scenario_key(scenario):
+    #   Results of version 1 have no mode, and were all plain
+    return (scenario["benches"], scenario["depth"], scenario["shelf_density"],
+            scenario.get("mode", "plain"))
+
+
+def compare(baseline, current, tolerance, noise_floor, statistic="min"):
+    """
+    Prints the change in `statistic` of every command present in both
+    result sets. Returns the number of regressions.
+    """
+    base = {scenario_key(s): s for s in baseline["scenarios"]}
+    regressions = 0
+    print("{:>7} {:>5} {:>7} {:<13}  {:<12} {:>10} {:>10} {:>8}".format(
+        "BENCHES", "DEPTH", "SHELVES", "MODE", "COMMAND",
+        "BASE " + statistic, statistic, "CHANGE"))
+    for scenario in current["scenarios"]:
+        old = base.get(scenario_key(scenario))
+        if old is None:
+            continue
+        for label, result in sorted(scenario["results"].items()):
+            if label not in old["results"]:
+                continue
+            was, now = old["results"][label][statistic], result[statistic]
+            change = (now - was) / was if was else 0.0
+            flag = ""
+            if old["results"][label]["runs"] < MIN_COMPARE_REPEAT:
+                flag = "  TOO FEW BASELINE RUNS"
+            elif change > tolerance and now - was > noise_floor:
+                flag = "  REGRESSED"
+                regressions += 1
+            print("{:>7} {:>5} {:>7} {:<13}  {:<12} {:>10.3f} {:>10.3f} "
+                  "{:>+7.1%}{}".format(*scenario_key(scenario), label, was,
+                                       now, change, flag))
+    return regressions
+
+
+# -----------------------------------------------------------------------------
+#
+#   main
+#
+# -----------------------------------------------------------------------------
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def float_list(value):
+    return [float(v) for v in value.split(",")]
+
+
+def mode_list(value):
+    modes = value.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            raise argparse.ArgumentTypeError(
+                "unknown mode '{}', expected one of {}".format(
+                    mode, ", ".join(MODES)))
+    return modes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--benches", type=int_list, default=[100, 1000],
+                        help="comma separated bench counts (up to 50000)")
+    parser.add_argument("--depth", type=int_list, default=[1, 4],
+                        help="comma separated bench depths (1 to 12)")
+    parser.add_argument("--shelf-density", type=float_list, default=[0.5],
+                        help="comma separated fractions of directories "
+                             "having a shelf (0 to 1)")
+    parser.add_argument("--mode", type=mode_list, default=list(MODES),
+                        help="comma separated caches to turn on, from {} "
+                             "(default: all)".format(", ".join(MODES)))
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="runs of each command per scenario, after one "
+                             "to warm up (at least {} with --compare)"
+                             .format(MIN_COMPARE_REPEAT))
+    parser.add_argument("-o", "--output",
+                        help="write results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="compare against results in this JSON file")
+    parser.add_argument("--statistic", default="min",
+                        choices=["min", "p50", "mean"],
+                        help="the time compared against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed fractional increase of the statistic")
+    parser.add_argument("--noise-floor", type=float, default=2.0,
+                        help="ignore increases of the statistic below this "
+                             "many ms")
+    args = parser.parse_args()
+    for benches in args.benches:
+        if not 1 <= benches <= 50000:
+            parser.error("--benches must be within 1 and 50000")
+    for depth in args.depth:
+        if not 1 <= depth <= 12:
+            parser.error("--depth must be within 1 and 12")
+    for density in args.shelf_density:
+        if not 0 <= density <= 1:
+            parser.error("--shelf-density must be within 0 and 1")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if args.compare and args.repeat < MIN_COMPARE_REPEAT:
+        parser.error("--compare needs --repeat of at least {}".format(
+            MIN_COMPARE_REPEAT))
+    return args
+
+
+def main():
+    args = parse_args()
+    version = subprocess.run([EXECUTOR, WB, "-V"], stdout=subprocess.PIPE,
+                             env=wb_env(WB_DIR, WB_DIR)).stdout
+    results = dict(
+        version=RESULTS_VERSION,
+        wb_version=version.decode().strip(),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        cpus=os.cpu_count(),
+        scenarios=[],
+    )
+    work_dir = tempfile.mkdtemp(prefix="wb_bench_")
+    try:
+        for benches, depth, density, mode in itertools.product(
+                args.benches, args.depth, args.shelf_density, args.mode):
+            print("benches={} depth={} shelf_density={} mode={}".format(
+                benches, depth, density, mode), file=sys.stderr, flush=True)
+            results["scenarios"].append(run_scenario(
+                benches, depth, density, mode, args.repeat,
+                join(work_dir, "scenario")))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.tolerance,
+                              args.noise_floor, args.statistic)
+        if regressions:
+            print("{} regression(s)".format(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
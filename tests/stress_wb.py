@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for WorkBench.
+
+Starts rounds of --concurrency `wb` invocations at the same moment against
+one synthetic WORKBENCH_HOME. Each invocation is an operation drawn from a
+mix of runs, listings and creations, so that benches are created while
+others are listed and run.
+
+    tests/stress_wb.py --concurrency 200 --rounds 5 -o stress.json
+
+Prints the throughput, and the latency percentiles of each operation in
+milliseconds. The exit code is 1 if any invocation exited with a code
+other than those documented for its operation, a listing printed an error
+or a bench which doesn't exist, or a temporary file was left behind.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from os import makedirs, listdir
+from os.path import join
+
+from bench_wb import (EXECUTOR, WB, WB_DIR, BENCH_EXTN, generate_home,
+                      summarize)
+
+RESULTS_VERSION=1
+
+ERR_FATAL=1
+ERR_MISSING=3
+ERR_INVALID=4
+ERR_DECLINED=5
+ERR_EXISTS=6
+ERR_CODES={0, ERR_FATAL, ERR_MISSING, ERR_INVALID, ERR_DECLINED, ERR_EXISTS}
+
+#   Temporary files are written as '<name>.<pid>' and renamed into place
+TEMP_FILE=re.compile(r"\.[0-9]+$")
+
+
+# -----------------------------------------------------------------------------
+#
+#   Operations
+#
+# -----------------------------------------------------------------------------
+
+#   Each operation has a weight in the mix, the exit codes that it may
+#   return, and a function giving its args and extra env from its sequence
+#   number and the names of the existing benches.
+OPERATIONS = {
+    "run": (8, {0},
+            lambda i, names: (["r", names[i % len(names)], "true"], {})),
+    "run_cached": (4, {0},
+                   lambda i, names: (["r", names[i % len(names)], "true"],
+                                     {"WORKBENCH_COMPOSE_CACHE": "1"})),
+    "run_snapshot": (2, {0},
+                     lambda i, names: (["r", names[i % len(names)], "true"],
+                                       {"WORKBENCH_SNAPSHOT": "1"})),
+    "run_warm": (2, {0},
+                 lambda i, names: (["r", "--warm", names[i % len(names)],
+                                    "true"], {})),
+    "run_missing": (1, {ERR_MISSING},
+                    lambda i, names: (["r", "missing/b{}".format(i), "true"],
+                                      {})),
+    "list_benches": (3, {0}, lambda i, names: (["b"], {})),
+    "list_shelves": (1, {0}, lambda i, names: (["s"], {})),
+    "list_indexed": (2, {0}, lambda i, names: (["b"],
+                                               {"WORKBENCH_INDEX": "1"})),
+    "new": (2, {0}, lambda i, names: (["n", "new/n{}".format(i)], {})),
+    "new_existing": (1, {ERR_EXISTS},
+                     lambda i, names: (["n", names[i % len(names)]], {})),
+    "create": (2, {0},
+               lambda i, names: (["b", "-n", "created/c{}".format(i), "true"],
+                                 {})),
+}
+
+
+def wb_env(home, user_home, tmp_dir):
+    env = {k: v for k, v in os.environ.items()
+           if not k.startswith("WORKBENCH_")}
+    env.update(HOME=user_home, WORKBENCH_HOME=home, TMPDIR=tmp_dir)
+    return env
+
+
+def run_operation(op, seq, names, env):
+    """Runs one operation. Returns its result as a dict."""
+    weight, codes, build = OPERATIONS[op]
+    args, extra = build(seq, names)
+    start = time.perf_counter()
+    cp = subprocess.run([EXECUTOR, WB] + args, env=dict(env, **extra),
+                        cwd=WB_DIR, stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return dict(op=op, args=args, ms=(time.perf_counter() - start) * 1000,
+                code=cp.returncode, ok=cp.returncode in codes,
+                stdout=cp.stdout.decode("utf-8", "replace"),
+                stderr=cp.stderr.decode("utf-8", "replace"))
+
+
+def run_round(ops, first_seq, names, env):
+    """
+    Starts every operation in `ops` in its own thread, released at the same
+    moment. Returns their results, and the wall time of the round in ms.
+    """
+    barrier = threading.Barrier(len(ops) + 1)
+    results = [None] * len(ops)
+
+    def worker(idx, op):
+        barrier.wait()
+        results[idx] = run_operation(op, first_seq + idx, names, env)
+
+    threads = [threading.Thread(target=worker, args=(idx, op))
+               for idx, op in enumerate(ops)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    return results, (time.perf_counter() - start) * 1000
+
+
+# -----------------------------------------------------------------------------
+#
+#   Checks
+#
+# -----------------------------------------------------------------------------
+
+def stop_warm_servers(cache_dir):
+    """Stops the servers started by 'wb r --warm', and waits for them."""
+    pids = []
+    warm_dir = join(cache_dir, "warm")
+    for root, dirs, files in os.walk(warm_dir):
+        if "server" in files:
+            with open(join(root, "server")) as f:
+                pids.append(int(f.readline()))
+    for pid in pids:
+        try:
+            os.kill(pid, 15)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + 5
+    for pid in pids:
+        while time.monotonic() < deadline:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                break
+            time.sleep(0.05)
+
+
+def leaked_files(home, cache_dir, tmp_dir):
+    """
+    Lists temporary files left behind: anything in TMPDIR, files named like
+    a temporary file under WORKBENCH_HOME, and fifos other than the
+    request fifo of each warm server.
+    """
+    warm_dir = join(cache_dir, "warm")
+    leaks = [join(tmp_dir, name) for name in listdir(tmp_dir)]
+    for root, dirs, files in os.walk(home):
+        dirs[:] = [d for d in dirs if join(root, d) != warm_dir]
+        leaks += [join(root, name) for name in files
+                  if TEMP_FILE.search(name)]
+    for root, dirs, files in os.walk(warm_dir):
+        leaks += [join(root, name) for name in files
+                  if name not in ("in", "server")]
+    return sorted(leaks)
+
+
+def check_listing(result, benches):
+    """Returns a description of what's wrong with a listing, if anything."""
+    if result["stderr"]:
+        return "printed to stderr: {}".format(result["stderr"].strip())
+    listed = result["stdout"].split()
+    if len(listed) != len(set(listed)):
+        return "listed a bench twice"
+    unknown = [name for name in listed if name not in benches]
+    if unknown:
+        return "listed benches which don't exist: {}".format(
+            " ".join(unknown[:5]))
+    return None
+
+
+def existing_benches(home):
+    names = set()
+    suffix = "." + BENCH_EXTN
+    for root, dirs, files in os.walk(home):
+        for name in files:
+            if name.endswith(suffix):
+                rel = os.path.relpath(join(root, name), home)
+                names.add(rel[:-len(suffix)])
+    return names
+
+
+# -----------------------------------------------------------------------------
+#
+#   main
+#
+# -----------------------------------------------------------------------------
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="invocations started at the same moment")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="rounds of concurrent invocations")
+    parser.add_argument("--benches", type=int, default=200,
+                        help="benches in the synthetic WORKBENCH_HOME")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="depth of each bench")
+    parser.add_argument("--only", metavar="OP", action="append",
+                        choices=sorted(OPERATIONS),
+                        help="run only this operation; may be repeated")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for drawing operations from the mix")
+    parser.add_argument("-o", "--output",
+                        help="write results as JSON to this file")
+    args = parser.parse_args()
+    if not 1 <= args.concurrency <= 2000:
+        parser.error("--concurrency must be within 1 and 2000")
+    if args.rounds < 1:
+        parser.error("--rounds must be at least 1")
+    if not 1 <= args.benches <= 50000:
+        parser.error("--benches must be within 1 and 50000")
+    if not 1 <= args.depth <= 12:
+        parser.error("--depth must be within 1 and 12")
+    return args
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    mix = args.only or sorted(OPERATIONS)
+    weights = [OPERATIONS[op][0] for op in mix]
+
+    work_dir = tempfile.mkdtemp(prefix="wb_stress_")
+    home = join(work_dir, "wbhome")
+    user_home = join(work_dir, "home")
+    tmp_dir = join(work_dir, "tmp")
+    cache_dir = join(home, ".wbcache")
+    failures = []
+    results = []
+    round_ms = []
+    try:
+        makedirs(user_home)
+        makedirs(tmp_dir)
+        names = generate_home(home, args.benches, args.depth, 0.5)
+        env = wb_env(home, user_home, tmp_dir)
+        for r in range(args.rounds):
+            ops = rng.choices(mix, weights, k=args.concurrency)
+            print("round {}: {} invocations".format(r + 1, len(ops)),
+                  file=sys.stderr, flush=True)
+            done, ms = run_round(ops, r * args.concurrency, names, env)
+            results += done
+            round_ms.append(ms)
+        stop_warm_servers(cache_dir)
+
+        benches = existing_benches(home)
+        for result in results:
+            where = "wb {}".format(" ".join(result["args"]))
+            if result["code"] not in ERR_CODES:
+                failures.append("{}: undocumented exit code {}".format(
+                    where, result["code"]))
+            elif not result["ok"]:
+                failures.append("{}: exit code {}: {}".format(
+                    where, result["code"], result["stderr"].strip()))
+            if result["op"].startswith("list_") and result["op"] != \
+               "list_shelves":
+                problem = check_listing(result, benches)
+                if problem:
+                    failures.append("{}: {}".format(where, problem))
+        for path in leaked_files(home, cache_dir, tmp_dir):
+            failures.append("leaked: {}".format(path))
+    finally:
+        stop_warm_servers(cache_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    total_ms = sum(round_ms)
+    report = dict(
+        version=RESULTS_VERSION,
+        platform=platform.platform(),
+        python=platform.python_version(),
+        cpus=os.cpu_count(),
+        concurrency=args.concurrency,
+        rounds=args.rounds,
+        benches=args.benches,
+        depth=args.depth,
+        invocations=len(results),
+        throughput=round(len(results) / (total_ms / 1000), 3),
+        latency=summarize([r["ms"] for r in results]),
+        operations={op: summarize([r["ms"] for r in results
+                                   if r["op"] == op])
+                    for op in sorted({r["op"] for r in results})},
+        failures=failures,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    print("{} invocations, {:.1f}/s".format(len(results),
+                                            report["throughput"]))
+    print("{:<14} {:>5} {:>9} {:>9} {:>9} {:>9}".format(
+        "OPERATION", "RUNS", "p50", "p90", "p99", "max"))
+    for op, s in sorted(report["operations"].items()):
+        print("{:<14} {:>5} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            op, s["runs"], s["p50"], s["p90"], s["p99"], s["max"]))
+    for failure in failures:
+        print("FAILED {}".format(failure))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
+import multiprocessing
+import shlex
+import signal
 import subprocess
+import tempfile
 import unittest
 import shutil
+import time
+import sys
 
-from os import makedirs
+from os import makedirs, remove, listdir, kill, killpg, utime, symlink
+from os import access, chmod, get_exec_path, stat, X_OK
 from os.path import abspath, dirname, join, basename, exists, isdir
 
 WB_DIR=abspath(join(dirname(__file__), ".."))
@@ -20,12 +27,18 @@ ERR_EXISTS=6
 EXECUTOR="bash"
 EXECUTOR_VERSION_FLAG=" --version"
 
+# POSIX sh which workbenches composed with WORKBENCH_POSIX are tested under
+DASH=shutil.which("dash")
+
+# HOME for commands run by the test in progress. Set by WbTestCase.
+TEST_HOME=None
+
 #
 #   Unset all env vars which might affect wb's functionality. Values for
 #   these might get picked up from the env in which the tests are run.
 #
 CMD_PREFIX=(
-    "HOME={td}/emptyrc "
+    "HOME={home} "
     "WORKBENCH_RC= "
     "WORKBENCH_HOME= "
     "WORKBENCH_BENCH_EXTN= "
@@ -38,6 +51,22 @@ CMD_PREFIX=(
     "WORKBENCH_NEW_FUNC= "
     "WORKBENCH_AUTOCONFIRM= "
     "WORKBENCH_ALLOW_INSECURE_PATH= "
+    "WORKBENCH_CACHE_DIR= "
+    "WORKBENCH_INDEX= "
+    "WORKBENCH_LIST_UNSORTED= "
+    "WORKBENCH_COMPOSE_CACHE= "
+    "WORKBENCH_PROFILE= "
+    "WORKBENCH_TRACE= "
+    "WORKBENCH_SNAPSHOT= "
+    "WORKBENCH_EXEC_FD= "
+    "WORKBENCH_MANIFEST= "
+    "WORKBENCH_WATCH_INTERVAL= "
+    "WORKBENCH_MIRROR= "
+    "WORKBENCH_MIRROR_INTERVAL= "
+    "WORKBENCH_WARM_TIMEOUT= "
+    "WORKBENCH_POSIX= "
+    "WORKBENCH_POSIX_CMD= "
+    "WORKBENCH_RESOLVE= "
 )
 
 
@@ -45,7 +74,8 @@ def run(cmd, **kwargs):
     if not isinstance(cmd, str):
         raise ValueError("Expected command to be a string")
     replace = kwargs.pop("replace", {})
-    wb_data = dict(td=TESTDATA, wb="{} {}".format(EXECUTOR, WB))
+    wb_data = dict(td=TESTDATA, home=TEST_HOME or join(TESTDATA, "emptyrc"),
+                   wb="{} {}".format(EXECUTOR, WB))
     wb_data.update(replace)
     cmd = CMD_PREFIX.format(**wb_data) + cmd.format(**wb_data)
     run_args = dict(
@@ -121,7 +151,45 @@ check_realpath()
 # -----------------------------------------------------------------------------
 
 
-class TestWbRCFile(unittest.TestCase):
+
+class WbTestCase(unittest.TestCase):
+    """
+    Gives each test a temporary directory at `tmp_dir`. It holds an empty
+    HOME for every command run by the test, and the WORKBENCH_HOME of
+    tests which create one, at `test_dir`. Tests don't share any writable
+    directory, and can run in parallel.
+    """
+
+    def setUp(self):
+        global TEST_HOME
+        self.tmp_dir = tempfile.mkdtemp(prefix="wb_test_")
+        self.test_dir = join(self.tmp_dir, "wbhome")
+        TEST_HOME = join(self.tmp_dir, "home")
+        makedirs(TEST_HOME)
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.addCleanup(globals().update, TEST_HOME=None)
+
+    #   Variables set for every command run by wb(), unless overridden
+    wb_env = {}
+
+    def _write(self, name, content, mode="w"):
+        """Writes the file `name` within `test_dir`"""
+        with open(join(self.test_dir, name), mode) as f:
+            f.write(content)
+
+    def wb(self, args, **env):
+        """
+        Runs 'wb <args>' with WORKBENCH_HOME at `test_dir`, and the
+        variables of `wb_env` and `env` set. `args` is formatted by run().
+        """
+        assigns = ["{}={}".format(name, shlex.quote(value))
+                   .replace("{", "{{").replace("}", "}}")
+                   for name, value in dict(self.wb_env, **env).items()]
+        return run(" ".join(assigns + ["WORKBENCH_HOME={home} {wb} " + args]),
+                   replace=dict(home=self.test_dir))
+
+
+class TestWbRCFile(WbTestCase):
 
     def test_consume_from_workbenchrc_default(self):
         """
@@ -175,7 +243,7 @@ class TestWbRCFile(unittest.TestCase):
             self.assertTrue(entry.startswith("WORKBENCH_"))
 
 
-class TestWbShelfAndBenchOps(unittest.TestCase):
+class TestWbShelfAndBenchOps(WbTestCase):
 
     # LIST SHELVES AND BENCHES
 
@@ -206,6 +274,21 @@ class TestWbShelfAndBenchOps(unittest.TestCase):
             "outer/inner/"
         ]))
 
+    def test_list_unsorted(self):
+        """
+        WORKBENCH_LIST_UNSORTED=1 wb s|b
+        Lists the same names as 'wb s|b', in the order they are found
+        """
+        for c in ["s", "b"]:
+            sorted_o = run("WORKBENCH_HOME={td}/wbhome {wb} {c}",
+                           replace=dict(c=c))
+            o = run("WORKBENCH_LIST_UNSORTED=1 WORKBENCH_HOME={td}/wbhome "
+                    "{wb} {c}", replace=dict(c=c))
+            self.assertEqual(o.stderr, "")
+            self.assertEqual(o.returncode, 0)
+            self.assertEqual(sorted(o.stdout.strip().split('\n')),
+                             sorted_o.stdout.strip().split('\n'))
+
     # SHOW PATH TO SHELF AND BENCH FILES
 
     def _test_print_path_to_file(self, wb_cmd, name, missing=False):
@@ -297,7 +380,8 @@ class TestWbShelfAndBenchOps(unittest.TestCase):
 
     def _rm_kwargs(self, prefix, wb_cmd, name, stdin=""):
         kw = dict(
-            replace=dict(prefix=prefix, wb_cmd=wb_cmd, name=name)
+            replace=dict(prefix=prefix, wb_cmd=wb_cmd, name=name,
+                         rm_test=join(self.tmp_dir, "rm_test"))
         )
         if stdin:
             kw["encoding"] = "ascii"
@@ -310,7 +394,7 @@ class TestWbShelfAndBenchOps(unittest.TestCase):
         When the command is 'rm', an interactive prompt is presented.
         Removal occurs only when confirmed.
         """
-        rm_test_dir = join(TESTDATA, "wbhome/rm_test")
+        rm_test_dir = join(self.tmp_dir, "rm_test")
         try:
             self._cleanup_before_test(rm_test_dir)
             filename = GET_FILENAME[wb_cmd[0]](rm_test_dir, name)
@@ -322,7 +406,7 @@ class TestWbShelfAndBenchOps(unittest.TestCase):
             # Expect ERR_DECLINED. Expect file to remain
             kw = self._rm_kwargs(prefix, wb_cmd, name, stdin="n")
 
-            o = run("WORKBENCH_HOME={td}/wbhome/rm_test "
+            o = run("WORKBENCH_HOME={rm_test} "
                     "{prefix} {wb} {wb_cmd} {name} rm",
                     **kw)
             self.assertEqual(o.stdout, "")
@@ -333,7 +417,7 @@ class TestWbShelfAndBenchOps(unittest.TestCase):
             # --- Test with "y" (Yes) on prompt ---------------------------
             # Expect succcess. Expect file to get deleted
             kw = self._rm_kwargs(prefix, wb_cmd, name, stdin="y")
-            o = run("WORKBENCH_HOME={td}/wbhome/rm_test "
+            o = run("WORKBENCH_HOME={rm_test} "
                     "{prefix} {wb} {wb_cmd} {name} rm",
                     **kw)
 
@@ -353,7 +437,7 @@ class TestWbShelfAndBenchOps(unittest.TestCase):
 
         Will assume Yes always and will not provide an interactive prompt
         """
-        rm_test_dir = join(TESTDATA, "wbhome/rm_test")
+        rm_test_dir = join(self.tmp_dir, "rm_test")
         try:
             self._cleanup_before_test(rm_test_dir)
             filename = GET_FILENAME[wb_cmd[0]](rm_test_dir, name)
@@ -362,7 +446,7 @@ class TestWbShelfAndBenchOps(unittest.TestCase):
                 self._create_new_through_testcode(filename)
 
             kw = self._rm_kwargs(prefix, wb_cmd, name)
-            o = run("WORKBENCH_HOME={td}/wbhome/rm_test "
+            o = run("WORKBENCH_HOME={rm_test} "
                     "{prefix} {wb} {wb_cmd} {name} rm",
                     **kw)
 
@@ -404,7 +488,7 @@ class TestWbShelfAndBenchOps(unittest.TestCase):
                                             new_flag=new_flag)
 
 
-class TestWbExecute(unittest.TestCase):
+class TestWbExecute(WbTestCase):
 
     def _test_list_benches(self, c):
         o = run("WORKBENCH_ENV_NAME= "
@@ -426,6 +510,28 @@ class TestWbExecute(unittest.TestCase):
         for c in ["a", "r", "n"]:
             self._test_list_benches(c)
 
+    def test_execute_exits_with_exit_code_of_entrypoint(self):
+        """
+        wb a|r|n <benchName>
+        Exits with the exitCode of the entrypoint, however the workbench
+        is passed to the executor
+        """
+        home = join(self.tmp_dir, "wbhome")
+        makedirs(home)
+        with open(join(home, "wb.shelf"), "w") as f:
+            f.write("workbench_OnActivate () { return 5; }\n"
+                    "workbench_OnRun () { return 6; }\n"
+                    "workbench_OnNew () { return 7; }\n")
+        with open(join(home, "one.bench"), "w") as f:
+            f.write("")
+        for env in ["", "WORKBENCH_EXEC_FD=1", "WORKBENCH_COMPOSE_CACHE=1"]:
+            for cmd, code in [("a one", 5), ("r one", 6), ("n two", 7)]:
+                o = run("WORKBENCH_ENV_NAME= WORKBENCH_HOME={home} "
+                        "WORKBENCH_ACTIVATE_CMD='{executor} -c' " + env +
+                        " {wb} " + cmd,
+                        replace=dict(home=home, executor=EXECUTOR))
+                self.assertEqual(o.returncode, code, (env, cmd, o.stderr))
+
     def test_cant_create_new_bench_when_one_already_exists(self):
         """
         wb n <benchName> when <benchName> already exists raises error
@@ -625,7 +731,7 @@ class TestWbExecute(unittest.TestCase):
         The 'workbench_OnNew' from the last sourced file (rm_test_new) will
         take effect.
         """
-        rm_test_dir = join(TESTDATA, "wbhome/rm_test_new")
+        rm_test_dir = join(self.tmp_dir, "rm_test_new")
         try:
             if exists(rm_test_dir) and isdir(rm_test_dir):
                 shutil.rmtree(rm_test_dir)
@@ -635,8 +741,9 @@ class TestWbExecute(unittest.TestCase):
                 f.write("workbench_OnNew () { echo \"Default-New\" $@; }\n")
 
             o = run("WORKBENCH_ENV_NAME= "
-                    "WORKBENCH_HOME={td}/wbhome/rm_test_new "
-                    "{wb} n nested/new_one 1 2 3")
+                    "WORKBENCH_HOME={home} "
+                    "{wb} n nested/new_one 1 2 3",
+                    replace=dict(home=rm_test_dir))
             self.assertEqual(o.stderr, "")
             self.assertEqual(o.returncode, 0)
             self.assertEqual(o.stdout.strip(), "Default-New 1 2 3")
@@ -649,7 +756,7 @@ class TestWbExecute(unittest.TestCase):
         must create the bench file at '<WORKBENCH_HOME>/<newBench>.bench',
         not at a path relative to the current working directory.
         """
-        rm_test_dir = join(TESTDATA, "wbhome/rm_test_default_new")
+        rm_test_dir = join(self.tmp_dir, "rm_test_default_new")
         stray_dir = join(WB_DIR, "nested")
         try:
             if exists(rm_test_dir) and isdir(rm_test_dir):
@@ -657,8 +764,9 @@ class TestWbExecute(unittest.TestCase):
             makedirs(rm_test_dir, exist_ok=True)
 
             o = run("WORKBENCH_ENV_NAME= "
-                    "WORKBENCH_HOME={td}/wbhome/rm_test_default_new "
-                    "{wb} n nested/new_one")
+                    "WORKBENCH_HOME={home} "
+                    "{wb} n nested/new_one",
+                    replace=dict(home=rm_test_dir))
             self.assertEqual(o.stderr, "")
             self.assertEqual(o.returncode, 0)
 
@@ -729,8 +837,1676 @@ class TestWbExecute(unittest.TestCase):
             self.assertEqual(o.stdout.strip(), cmd)
 
 
+class TestWbAutoload(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "outer"))
+        makedirs(join(self.test_dir, "lib"))
+        self._write("wb.shelf",
+                    "workbench_autoload lib/greet.sh hello bye\n")
+        self._write("outer/one.bench", "")
+        self._write("lib/greet.sh",
+                    "echo LOADED\n"
+                    "hello () { echo hello \"$@\"; }\n"
+                    "bye () { echo bye \"$@\"; }\n")
+
+    wb_env = dict(WORKBENCH_ENV_NAME="")
+
+    def test_autoload_on_first_call(self):
+        """
+        workbench_autoload <file> <function>..
+        The file is sourced once; when any of its functions is first called
+        """
+        for snapshot in ["", "1", "1"]:
+            o = self.wb("r outer/one eval 'echo START; hello a; bye b; "
+                        "hello c'", WORKBENCH_SNAPSHOT=snapshot)
+            self.assertEqual(o.stderr, "")
+            self.assertEqual(o.returncode, 0)
+            self.assertEqual(o.stdout.split('\n'), [
+                "START", "LOADED", "hello a", "bye b", "hello c", ""])
+
+    def test_autoload_on_new(self):
+        """
+        wb n <benchName>
+        Functions autoloaded by shelves are available to the entrypoint
+        """
+        self._write("outer/wb.shelf", "workbench_OnNew () { bye new; }\n")
+        o = self.wb("n outer/two")
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.stdout.split('\n'), ["LOADED", "bye new", ""])
+
+    def test_autoload_undefined_function(self):
+        """
+        Calling a function which its file does not define fails with 127
+        """
+        self._write("wb.shelf",
+                    "workbench_autoload lib/greet.sh hello missing\n")
+        o = self.wb("r outer/one missing")
+        self.assertEqual(o.returncode, 127)
+        self.assertIn("Function 'missing' is not defined in '{}'".format(
+            join(self.test_dir, "lib", "greet.sh")), o.stderr)
+
+
+class TestWbIndex(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(self.test_dir)
+
+    def _list(self, home, c, index=True):
+        o = run("WORKBENCH_INDEX={index} WORKBENCH_HOME={home} "
+                "WORKBENCH_CACHE_DIR={cache} {wb} {c}",
+                replace=dict(home=home, c=c, index="1" if index else "",
+                             cache=join(self.test_dir, ".wbcache")))
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.returncode, 0)
+        return o.stdout
+
+    def test_index_listing_matches_walk(self):
+        """
+        WORKBENCH_INDEX=1 wb s|b
+        Lists exactly what a full walk of WORKBENCH_HOME lists
+        """
+        home = join(TESTDATA, "wbhome")
+        for c in ["s", "b"]:
+            self.assertEqual(self._list(home, c, index=True),
+                             self._list(home, c, index=False))
+            self.assertEqual(self._list(home, c, index=True),
+                             self._list(home, c, index=False))
+
+    def test_index_refreshes_changed_directories(self):
+        """
+        Benches and shelves added after the index was built are listed
+        """
+        makedirs(join(self.test_dir, "outer"))
+        with open(join(self.test_dir, "outer", "one.bench"), "w") as f:
+            f.write("")
+        self.assertEqual(self._list(self.test_dir, "b"), "outer/one\n")
+
+        makedirs(join(self.test_dir, "outer", "inner"))
+        for name in ["two.bench", "wb.shelf"]:
+            with open(join(self.test_dir, "outer", "inner", name), "w") as f:
+                f.write("")
+        self.assertEqual(self._list(self.test_dir, "b"),
+                         "outer/inner/two\nouter/one\n")
+        self.assertEqual(self._list(self.test_dir, "s"), "outer/inner/\n")
+
+        shutil.rmtree(join(self.test_dir, "outer", "inner"))
+        self.assertEqual(self._list(self.test_dir, "b"), "outer/one\n")
+
+    def test_index_reuses_unchanged_directories(self):
+        """
+        An unchanged index isn't rewritten, and a refresh after a change
+        writes what a full rebuild writes
+        """
+        for name in ["a/x", "a/y", "b/z", "c/d/e"]:
+            makedirs(join(self.test_dir, name))
+            self._write(join(name, "one.bench"), "")
+        self._write(join("a", "wb.shelf"), "")
+        index = join(self.test_dir, ".wbcache", "index")
+        listing = self._list(self.test_dir, "b")
+        stamp = stat(index).st_ino, stat(index).st_mtime_ns
+        self.assertEqual(self._list(self.test_dir, "b"), listing)
+        self.assertEqual((stat(index).st_ino, stat(index).st_mtime_ns), stamp)
+
+        makedirs(join(self.test_dir, "a", "x", "new", "deeper"))
+        self._write(join("a", "x", "new", "deeper", "two.bench"), "")
+        shutil.rmtree(join(self.test_dir, "b"))
+        self.assertEqual(self._list(self.test_dir, "b"),
+                         self._list(self.test_dir, "b", index=False))
+        with open(index) as f:
+            refreshed = f.read()
+        self.assertEqual(run("WORKBENCH_HOME={home} {wb} index",
+                             replace=dict(home=self.test_dir)).returncode, 0)
+        with open(index) as f:
+            self.assertEqual(f.read(), refreshed)
+
+    def test_rebuild_index_on_demand(self):
+        """
+        wb index
+        Rebuilds the index and prints its path
+        """
+        o = run("WORKBENCH_HOME={home} {wb} index",
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.returncode, 0)
+        index = join(self.test_dir, ".wbcache", "index")
+        self.assertEqual(o.stdout.strip(), index)
+        self.assertTrue(exists(index))
+
+
+class TestWbComposeCache(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "outer"))
+        self._write("wb.shelf", "echo ROOT\n")
+        self._write("outer/one.bench", "echo ONE\n")
+
+    wb_env = dict(WORKBENCH_ENV_NAME="", WORKBENCH_COMPOSE_CACHE="1")
+
+    def test_cached_workbench_is_reused(self):
+        """
+        WORKBENCH_COMPOSE_CACHE=1 wb r <benchName>
+        Composes and caches the workbench once, then executes the cache
+        """
+        cached = join(self.test_dir, ".wbcache", "compose", "outer", "one.r")
+        for _ in range(2):
+            o = self.wb("r outer/one echo '$WORKBENCH_EXEC_MODE' 'a  b'")
+            self.assertEqual(o.stderr, "")
+            self.assertEqual(o.returncode, 0)
+            self.assertEqual(o.stdout.split('\n'),
+                             ["ROOT", "ONE", "r a  b", ""])
+            self.assertTrue(exists(cached))
+
+    def test_cached_workbench_is_recomposed_on_chain_change(self):
+        """
+        Adding or modifying a shelf in the chain invalidates the cache
+        """
+        o = self.wb("r outer/one true")
+        self.assertEqual(o.stdout.split('\n'), ["ROOT", "ONE", ""])
+
+        self._write("outer/wb.shelf", "echo OUTER\n")
+        o = self.wb("r outer/one true")
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.stdout.split('\n'), ["ROOT", "OUTER", "ONE", ""])
+
+    def test_cached_workbench_args_match_composed(self):
+        """
+        Arguments expand as in the composed workbench. One which can't
+        be expanded fails both ways; it's never dropped.
+        """
+        for args, code in [("'$WORKBENCH_EXEC_MODE' \"it's\"", 0),
+                           ("'a\"b'", 2)]:
+            outputs = []
+            for cache in ["1", "1", ""]:
+                o = self.wb("r outer/one printf '<%s>' " + args,
+                            WORKBENCH_COMPOSE_CACHE=cache)
+                self.assertEqual(o.returncode, code, cache)
+                outputs.append(o.stdout)
+            self.assertEqual(len(set(outputs)), 1, outputs)
+        o = self.wb("r outer/one printf '<%s>' " + "'$WORKBENCH_EXEC_MODE'")
+        self.assertEqual(o.stdout, "ROOT\nONE\n<r>")
+
+    def test_run_returns_exit_code_of_entrypoint(self):
+        """
+        wb r <benchName> exits with the returnCode of the entrypoint
+        """
+        for cache in ["1", ""]:
+            o = self.wb("r outer/one false", WORKBENCH_COMPOSE_CACHE=cache)
+            self.assertEqual(o.returncode, 1)
+
+
+class TestWbTempFiles(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = join(self.tmp_dir, "tmp")
+        self.wb_env = dict(TMPDIR=self.temp_dir)
+        makedirs(join(self.test_dir, "outer"))
+        makedirs(self.temp_dir)
+        self._write("wb.shelf", "echo ROOT\n")
+        self._write("outer/one.bench", "echo ONE\n")
+
+    def test_exec_fd_writes_no_temp_file(self):
+        """
+        WORKBENCH_EXEC_FD=1 wb r <benchName> <command>
+        The workbench is passed through a pipe; never through a file
+        """
+        for executor in ["", "{}".format(EXECUTOR)]:
+            o = self.wb("r outer/one ls -A " + self.temp_dir,
+                        WORKBENCH_EXEC_FD="1", WORKBENCH_COMMAND_CMD=executor)
+            self.assertEqual(o.stderr, "")
+            self.assertEqual(o.returncode, 0)
+            self.assertEqual(o.stdout.split('\n'), ["ROOT", "ONE", ""])
+        o = self.wb("r outer/one false", WORKBENCH_EXEC_FD="1")
+        self.assertEqual(o.returncode, 1)
+
+    def test_temp_file_removed_on_terminate(self):
+        """
+        wb r <benchName> <command>
+        The temp file is removed even if wb is terminated while running
+        """
+        cmd = CMD_PREFIX.format(home=TEST_HOME) + \
+            "TMPDIR={} WORKBENCH_HOME={} exec {} {} r outer/one sleep 5" \
+            .format(self.temp_dir, self.test_dir, EXECUTOR, WB)
+        p = subprocess.Popen(cmd, shell=True, cwd=WB_DIR,
+                             start_new_session=True,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL)
+        deadline = time.time() + 3
+        while not listdir(self.temp_dir) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(listdir(self.temp_dir)), 1)
+        killpg(p.pid, signal.SIGTERM)
+        self.assertEqual(p.wait(timeout=5), 128 + signal.SIGTERM)
+        self.assertEqual(listdir(self.temp_dir), [])
+
+
+class TestWbProfile(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "outer"))
+        self._write("wb.shelf", "echo ROOT\n")
+        self._write("outer/one.bench", "echo ONE\n")
+
+    def _records(self, text):
+        return [l.split('\t') for l in text.split('\n') if l]
+
+    def test_profile_to_stderr(self):
+        """
+        wb --profile r <benchName> <command>
+        Reports phases, external commands and the total on stderr
+        """
+        o = run("WORKBENCH_HOME={home} {wb} --profile r outer/one false",
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.returncode, 1)
+        self.assertEqual(o.stdout.split('\n'), ["ROOT", "ONE", ""])
+        records = self._records(o.stderr)
+        self.assertTrue(all(r[0] == "wbprof" for r in records))
+        self.assertTrue(all(len(r) == 5 for r in records))
+        phases = [r[2] for r in records if r[1] == "phase"]
+        for phase in ["rcfile", "resolve", "compose", "executor",
+                      "source", "entrypoint", "exit", "cleanup"]:
+            self.assertIn(phase, phases)
+        commands = [r[2] for r in records if r[1] == "command"]
+        self.assertIn("mktemp", commands)
+        total = records[-1]
+        self.assertEqual(total[1:3], ["total", "r outer/one false"])
+        self.assertGreater(int(total[4]), 0)
+
+    def test_profile_to_file(self):
+        """
+        WORKBENCH_PROFILE=<file> wb r <benchName> <command>
+        Appends a report to <file> for every invocation
+        """
+        profile = join(self.test_dir, "profile.tsv")
+        for _ in range(2):
+            o = run("WORKBENCH_PROFILE={profile} WORKBENCH_HOME={home} "
+                    "{wb} r outer/one true",
+                    replace=dict(home=self.test_dir, profile=profile))
+            self.assertEqual(o.returncode, 0)
+            self.assertEqual(o.stderr, "")
+        with open(profile) as f:
+            records = self._records(f.read())
+        self.assertEqual(len([r for r in records if r[1] == "total"]), 2)
+
+    def test_profile_leaves_dump_unchanged(self):
+        """
+        wb --profile r -d <benchName>
+        The dumped workbench does not contain any profiling code
+        """
+        cmd = "WORKBENCH_HOME={home} {wb} %s r -d outer/one"
+        plain = run(cmd % "", replace=dict(home=self.test_dir))
+        profiled = run(cmd % "--profile", replace=dict(home=self.test_dir))
+        self.assertEqual(plain.stdout, profiled.stdout)
+
+    def test_trace_to_stderr(self):
+        """
+        wb --trace r <benchName> <command>
+        Reports the time to source each file and run the entrypoint
+        """
+        o = run("WORKBENCH_HOME={home} {wb} --trace r outer/one false",
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.returncode, 1)
+        self.assertEqual(o.stdout.split('\n'), ["ROOT", "ONE", ""])
+        records = self._records(o.stderr)
+        self.assertTrue(all(r[0] == "wbtrace" for r in records))
+        self.assertTrue(all(len(r) == 4 for r in records))
+        self.assertEqual([r[1:3] for r in records], [
+            ["source", join(self.test_dir, "wb.shelf")],
+            ["source", join(self.test_dir, "outer", "one.bench")],
+            ["entrypoint", "workbench_OnRun"],
+            ["total", "outer/one"],
+        ])
+
+    def test_trace_to_file(self):
+        """
+        WORKBENCH_TRACE=<file> wb r <benchName> <command>
+        Appends a trace to <file>, with or without a composed cache
+        """
+        trace = join(self.test_dir, "trace.tsv")
+        for cache in ["", "1", "1"]:
+            o = run("WORKBENCH_TRACE={trace} WORKBENCH_COMPOSE_CACHE={cache} "
+                    "WORKBENCH_HOME={home} {wb} r outer/one false",
+                    replace=dict(home=self.test_dir, trace=trace,
+                                 cache=cache))
+            self.assertEqual(o.returncode, 1)
+            self.assertEqual(o.stderr, "")
+        with open(trace) as f:
+            records = self._records(f.read())
+        self.assertEqual(len([r for r in records if r[1] == "total"]), 3)
+
+    def test_trace_leaves_dump_unchanged(self):
+        """
+        wb --trace r -d <benchName>
+        The dumped workbench does not contain any tracing code
+        """
+        cmd = "WORKBENCH_HOME={home} {wb} %s r -d outer/one"
+        plain = run(cmd % "", replace=dict(home=self.test_dir))
+        traced = run(cmd % "--trace", replace=dict(home=self.test_dir))
+        self.assertEqual(plain.stdout, traced.stdout)
+
+
+class TestWbCompletion(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "outer", "inner"))
+        for name in ["wb.shelf", "other.bench", "outer/one.bench",
+                     "outer/inner/two.bench"]:
+            self._write(name, "")
+
+    def _complete(self, *words):
+        o = run("WORKBENCH_HOME={home} {executor} -c '"
+                "wb () {{ {wb} \"$@\"; }}; source {complete}; "
+                "COMP_WORDS=(wb {words}); COMP_CWORD={cword}; "
+                "_wb_completion; printf \"%s\\n\" \"${{COMPREPLY[@]}}\"'",
+                replace=dict(home=self.test_dir, executor=EXECUTOR,
+                             complete=join(WB_DIR, "completion",
+                                           "wb_complete.bash"),
+                             words=" ".join('"%s"' % w for w in words),
+                             cword=len(words)))
+        self.assertEqual(o.stderr, "")
+        return sorted(l for l in o.stdout.split('\n') if l)
+
+    def test_complete_commands(self):
+        self.assertEqual(self._complete("c"), ["compile"])
+        self.assertEqual(self._complete("e"), ["export"])
+        self.assertEqual(self._complete("sn"), ["snapshot"])
+        self.assertEqual(self._complete("snapshot", "ot"), ["other"])
+        self.assertEqual(self._complete("--profile", "r"), ["r"])
+        self.assertEqual(self._complete("--trace", "--profile", "r"), ["r"])
+
+    def test_complete_one_segment_at_a_time(self):
+        """
+        Names are completed like directories; one segment at a time
+        """
+        self.assertEqual(self._complete("r", ""), ["other", "outer/"])
+        self.assertEqual(self._complete("a", "ou"), ["outer/"])
+        self.assertEqual(self._complete("b", "outer/"),
+                         ["outer/inner/", "outer/one"])
+        self.assertEqual(self._complete("r", "outer/inner/t"),
+                         ["outer/inner/two"])
+        self.assertEqual(self._complete("s", ""), ["/", "outer/"])
+        self.assertEqual(self._complete("r", "outer/one", ""), [])
+
+    def test_complete_skips_dot_entries(self):
+        """
+        Entries whose name starts with a dot aren't offered, even with
+        dotglob set in the shell, which is left as it was
+        """
+        makedirs(join(self.test_dir, ".git"))
+        makedirs(join(self.test_dir, "outer", ".hidden"))
+        self._write(".secret.bench", "")
+        o = run("WORKBENCH_HOME={home} {executor} -c '"
+                "wb () {{ {wb} \"$@\"; }}; source {complete}; "
+                "shopt -s dotglob; COMP_WORDS=(wb r \"\"); COMP_CWORD=2; "
+                "_wb_completion; printf \"%s\\n\" \"${{COMPREPLY[@]}}\"; "
+                "shopt -q dotglob && echo dotglob'",
+                replace=dict(home=self.test_dir, executor=EXECUTOR,
+                             complete=join(WB_DIR, "completion",
+                                           "wb_complete.bash")))
+        self.assertEqual(o.stdout, "other\nouter/\ndotglob\n")
+        self.assertEqual(self._complete("r", ""), ["other", "outer/"])
+        self.assertEqual(self._complete("r", "."), [])
+        self.assertEqual(self._complete("r", "outer/"),
+                         ["outer/inner/", "outer/one"])
+
+    def test_complete_after_change(self):
+        """
+        Cached entries of a directory are refreshed when it changes
+        """
+        self.assertEqual(self._complete("r", "outer/"),
+                         ["outer/inner/", "outer/one"])
+        self._write("outer/three.bench", "")
+        self.assertEqual(self._complete("r", "outer/"),
+                         ["outer/inner/", "outer/one", "outer/three"])
+
+
+class TestWbParallel(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "outer"))
+        for name in ["other", "outer/one", "outer/two"]:
+            self._write(name + ".bench", "")
+
+    wb_env = dict(WORKBENCH_ENV_NAME="")
+
+    def _table(self, stdout):
+        lines = stdout.split('\n')
+        start = [l.split() for l in lines].index(["EXIT", "SECONDS", "BENCH"])
+        return [(l.split()[0], l.split()[2]) for l in lines[start + 1:] if l]
+
+    def test_parallel_prefixes_output(self):
+        """
+        wb p -j <N> <selector>.. -- <command>
+        Prefixes each line of output with the benchName
+        """
+        o = self.wb("p -j 2 outer/ other -- echo '$WORKBENCH_ENV_NAME'")
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.returncode, 0)
+        for name in ["outer/one", "outer/two", "other"]:
+            self.assertIn("{0}: {0}".format(name), o.stdout.split('\n'))
+        self.assertEqual(self._table(o.stdout), [
+            ("0", "outer/one"), ("0", "outer/two"), ("0", "other")])
+
+    def test_parallel_selectors(self):
+        """
+        Selectors are benchNames, shelfNames ending with '/' and globs
+        """
+        o = self.wb("p 'o*o' outer/one outer/two -- true")
+        self.assertEqual(self._table(o.stdout), [
+            ("0", "outer/two"), ("0", "outer/one")])
+        o = self.wb("p / -- true")
+        self.assertEqual([n for _, n in self._table(o.stdout)],
+                         ["other", "outer/one", "outer/two"])
+
+    def test_parallel_output_dir(self):
+        """
+        wb p -o <dir> <selector>.. -- <command>
+        Writes the output of each workbench to <dir>/<benchName>.log
+        """
+        log_dir = join(self.test_dir, "logs")
+        o = self.wb("p -o {} outer/ -- echo '$WORKBENCH_ENV_NAME'"
+                    .format(log_dir))
+        self.assertEqual(o.returncode, 0)
+        for name in ["outer/one", "outer/two"]:
+            with open(join(log_dir, name + ".log")) as f:
+                self.assertEqual(f.read(), name + "\n")
+
+    def test_parallel_exit_codes(self):
+        """
+        ERR_FATAL if any workbench fails. ERR_MISSING if a selector
+        doesn't match any bench. ERR_INVALID on an invalid job count.
+        """
+        self._write("outer/one.bench", "workbench_OnRun () { return 3; }\n")
+        o = self.wb("p / -- true")
+        self.assertEqual(o.returncode, ERR_FATAL)
+        self.assertEqual(self._table(o.stdout), [
+            ("0", "other"), ("3", "outer/one"), ("0", "outer/two")])
+        self.assertEqual(self.wb("p outer/ nosuch").returncode,
+                         ERR_MISSING)
+        self.assertEqual(self.wb("p -j 0 outer/").returncode, ERR_INVALID)
+
+    def test_parallel_shared(self):
+        """
+        wb p --shared <selector>.. -- <command>
+        Sources each shelf once, and each bench in a child of its shelf
+        """
+        self._write("wb.shelf", "echo ROOT\n")
+        self._write("outer/wb.shelf", "echo OUTER\nOUTER_VAR=outer\n")
+        self._write("outer/two.bench", "workbench_OnRun () { return 2; }\n")
+        o = self.wb("p -s -j 2 / -- echo "
+                    "'$WORKBENCH_ENV_NAME:$OUTER_VAR:${{WORKBENCH_CHAIN##*/}}'")
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.returncode, ERR_FATAL)
+        lines = o.stdout.split('\n')
+        self.assertEqual(lines.count("ROOT"), 1)
+        self.assertEqual(lines.count("OUTER"), 1)
+        self.assertIn("other: other::other.bench", lines)
+        self.assertIn("outer/one: outer/one:outer:one.bench", lines)
+        self.assertEqual(self._table(o.stdout), [
+            ("0", "other"), ("0", "outer/one"), ("2", "outer/two")])
+
+
+class TestWbSnapshot(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "outer"))
+        self._write("wb.shelf", "\n".join([
+            "echo SOURCED >&2",
+            "export SLOW_PATH=/opt/slow",
+            "declare -A TOOLS=([py]=3)",
+            "helper () { echo \"helper $*\"; }",
+        ]))
+        self._write("outer/one.bench", "BENCH_VAR='a  b'\n")
+
+    wb_env = dict(WORKBENCH_ENV_NAME="", WORKBENCH_SNAPSHOT="1")
+
+    def test_snapshot_replaces_sourcing(self):
+        """
+        WORKBENCH_SNAPSHOT=1 wb r <benchName>
+        Sources the chain once, and the snapshot on later runs
+        """
+        cmd = ("r outer/one helper '$SLOW_PATH' '${{TOOLS[py]}}' "
+               "'$BENCH_VAR' '$WORKBENCH_CHAIN'")
+        chain = ":".join([join(self.test_dir, "wb.shelf"),
+                          join(self.test_dir, "outer", "one.bench")])
+        for stderr in ["SOURCED\n", ""]:
+            o = self.wb(cmd)
+            self.assertEqual(o.stderr, stderr)
+            self.assertEqual(o.stdout, "helper /opt/slow 3 a  b %s\n" % chain)
+
+    def test_snapshot_is_discarded_on_chain_change(self):
+        """
+        Modifying a file in the chain discards the snapshot
+        """
+        self.wb("r outer/one true")
+        self._write("outer/wb.shelf", "")
+        o = self.wb("r outer/one true")
+        self.assertEqual(o.stderr, "SOURCED\n")
+
+    def test_snapshot_list_and_delete(self):
+        """
+        wb snapshot [-d] [[benchName]..]
+        Lists or deletes snapshots
+        """
+        snapshot = join(self.test_dir, ".wbcache", "snapshot", "outer",
+                        "one.snapshot")
+        self.assertEqual(self.wb("snapshot").stdout, "")
+        self.wb("r outer/one true")
+        self.assertEqual(self.wb("snapshot").stdout, snapshot + "\n")
+        self.assertEqual(self.wb("snapshot outer/one").stdout,
+                         snapshot + "\n")
+        o = self.wb("snapshot -d outer/one")
+        self.assertEqual(o.returncode, 0)
+        self.assertFalse(exists(snapshot))
+        self.assertEqual(self.wb("r outer/one true").stderr, "SOURCED\n")
+
+
+class TestWbAffected(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "team", "x"))
+        makedirs(join(self.test_dir, "other"))
+        for name in ["wb.shelf", "team/wb.shelf", "team/x/wb.shelf",
+                     "team/a.bench", "team/x/b.bench", "other/c.bench",
+                     "teamz.bench"]:
+            self._write(name, "# {}\n".format(name))
+
+    def _affected(self, args):
+        o = run("cd {home} && WORKBENCH_HOME={home} {wb} affected " + args,
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.returncode, 0)
+        return [l for l in o.stdout.split('\n') if l]
+
+    def test_affected_by_shelf(self):
+        """
+        wb affected <shelfPath>
+        Lists every bench below the directory of the shelf
+        """
+        self.assertEqual(self._affected("team/wb.shelf"),
+                         ["team/a", "team/x/b"])
+        self.assertEqual(self._affected(join(self.test_dir, "wb.shelf")),
+                         ["other/c", "team/a", "team/x/b", "teamz"])
+
+    def test_affected_by_bench(self):
+        """
+        wb affected <benchPath> [[path]..]
+        A bench affects itself. Paths which are neither are ignored.
+        """
+        self.assertEqual(self._affected("teamz.bench team/x/wb.shelf "
+                                        "README.md /etc/passwd"),
+                         ["team/x/b", "teamz"])
+        self.assertEqual(self._affected("README.md"), [])
+
+    def test_affected_by_removed_shelf(self):
+        """
+        A removed shelf still affects the benches below it
+        """
+        remove(join(self.test_dir, "team", "wb.shelf"))
+        self.assertEqual(self._affected("team/wb.shelf"),
+                         ["team/a", "team/x/b"])
+
+    def test_affected_by_git_range(self):
+        """
+        wb affected --git <range>
+        Lists the benches affected by files changed in the git range
+        """
+        git = "git -c user.name=wb -c user.email=wb@localhost "
+        o = run("cd {home} && " + git + "init -q . && " + git + "add . && " +
+                git + "commit -q -m init",
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.returncode, 0)
+        self._write("team/x/wb.shelf", "# changed\n")
+        remove(join(self.test_dir, "other", "c.bench"))
+        self.assertEqual(self._affected("--git HEAD"), ["team/x/b"])
+        self.assertEqual(self._affected("--git HEAD teamz.bench"),
+                         ["team/x/b", "teamz"])
+        o = run("WORKBENCH_HOME={home} {wb} affected --git nonexistent",
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.returncode, 1)
+
+
+class TestWbManifest(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "team"))
+        self._write("wb.shelf", "# root\n")
+        self._write("team/a.bench", "# a\n")
+        self._write("team/b.bench", "# b\n")
+
+    def _manifest(self, args=""):
+        return self.wb("manifest " + args)
+
+    def test_manifest_missing(self):
+        """
+        wb manifest
+        Must fail if the manifest was never written
+        """
+        o = self._manifest()
+        self.assertEqual(o.returncode, 3)
+        self.assertIn("wb manifest -u", o.stderr)
+
+    def test_manifest_update(self):
+        """
+        wb manifest -u
+        Lists the files added, and then verifies clean. Touching a file
+        doesn't make it changed.
+        """
+        o = self._manifest("-u")
+        self.assertEqual(o.returncode, 0)
+        self.assertEqual(o.stdout, "A team/a.bench\nA team/b.bench\n"
+                                   "A wb.shelf\n")
+        o = self._manifest()
+        self.assertEqual((o.returncode, o.stdout, o.stderr), (0, "", ""))
+        utime(join(self.test_dir, "team", "a.bench"), (0, 0))
+        o = self._manifest()
+        self.assertEqual((o.returncode, o.stdout, o.stderr), (0, "", ""))
+
+    def test_manifest_changes(self):
+        """
+        wb manifest
+        Lists the files added, modified and deleted since the last update
+        """
+        self.assertEqual(self._manifest("-u").returncode, 0)
+        self._write("team/a.bench", "# changed\n")
+        self._write("team/c.bench", "# c\n")
+        remove(join(self.test_dir, "team", "b.bench"))
+        o = self._manifest()
+        self.assertEqual(o.returncode, 4)
+        self.assertEqual(o.stdout, "M team/a.bench\nD team/b.bench\n"
+                                   "A team/c.bench\n")
+        self.assertEqual(self._manifest().returncode, 4)
+        self.assertEqual(self._manifest("--update").returncode, 0)
+        self.assertEqual(self._manifest().returncode, 0)
+
+    def test_manifest_pre_execute_hook(self):
+        """
+        workbench_manifest_verify
+        Blocks execution from workbench_pre_execute_hook on a change
+        """
+        rc = join(self.tmp_dir, "manifest.rc")
+        with open(rc, "w") as f:
+            f.write("workbench_pre_execute_hook () {\n"
+                    "    workbench_manifest_verify >&2\n"
+                    "}\n")
+        self.assertEqual(self._manifest("-u").returncode, 0)
+        cmd = "WORKBENCH_RC={rc} WORKBENCH_HOME={home} {wb} r team/a echo ran"
+        o = run(cmd, replace=dict(rc=rc, home=self.test_dir))
+        self.assertEqual((o.returncode, o.stdout), (0, "ran\n"))
+        self._write("team/b.bench", "echo injected\n")
+        o = run(cmd, replace=dict(rc=rc, home=self.test_dir))
+        self.assertEqual(o.returncode, 4)
+        self.assertEqual(o.stdout, "")
+        self.assertIn("M team/b.bench", o.stderr)
+
+    def test_manifest_tracks_executable_caches(self):
+        """
+        wb manifest
+        Caches written by wb itself aren't reported, but a change made to
+        a composed workbench, bundle or snapshot by anything else is
+        """
+        cache = join(self.test_dir, ".wbcache")
+        self.assertEqual(self._manifest("-u").returncode, 0)
+        o = run("WORKBENCH_HOME={home} WORKBENCH_COMPOSE_CACHE=1 "
+                "{wb} r team/a true && "
+                "WORKBENCH_HOME={home} WORKBENCH_SNAPSHOT=1 "
+                "{wb} r team/b true && "
+                "WORKBENCH_HOME={home} {wb} compile team/a",
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.returncode, 0, o.stderr)
+        for name in ["compose/team/a.r", "bundle/team/a.bundle",
+                     "snapshot/team/b.snapshot"]:
+            self.assertTrue(exists(join(cache, name)), name)
+        o = self._manifest()
+        self.assertEqual((o.returncode, o.stdout, o.stderr), (0, "", ""))
+
+        for name in ["compose/team/a.r", "bundle/team/a.bundle",
+                     "snapshot/team/b.snapshot"]:
+            with open(join(cache, name), "a") as f:
+                f.write("echo injected\n")
+        o = self._manifest()
+        self.assertEqual(o.returncode, 4)
+        self.assertEqual(sorted(o.stdout.splitlines()),
+                         ["M " + join(cache, "bundle/team/a.bundle"),
+                          "M " + join(cache, "compose/team/a.r"),
+                          "M " + join(cache, "snapshot/team/b.snapshot")])
+
+        self.assertEqual(self._manifest("-u").returncode, 0)
+        o = run("WORKBENCH_HOME={home} {wb} snapshot --delete team/b",
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.returncode, 0, o.stderr)
+        o = self._manifest()
+        self.assertEqual((o.returncode, o.stdout, o.stderr), (0, "", ""))
+
+
+class TestWbWatch(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = join(self.test_dir, ".wbcache")
+        makedirs(join(self.test_dir, "team"))
+        self._write("wb.shelf", "# root\n")
+        self._write("team/wb.shelf", "# team\n")
+        self._write("team/a.bench", "# a\n")
+        self._write("b.bench", "# b\n")
+
+    def _read(self, name):
+        if not exists(join(self.cache_dir, name)):
+            return ""
+        with open(join(self.cache_dir, name)) as f:
+            return f.read()
+
+    def _start(self, env=""):
+        """Starts polling, and waits for the first scan"""
+        cmd = CMD_PREFIX.format(home=TEST_HOME) + env + \
+            " WORKBENCH_HOME={} exec {} {} watch --poll -i 0.1" \
+            .format(self.test_dir, EXECUTOR, WB)
+        p = subprocess.Popen(cmd, shell=True, cwd=WB_DIR,
+                             start_new_session=True,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        self.addCleanup(self._stop, p)
+        self.assertIn("Watching", p.stderr.readline().decode())
+        return p
+
+    def _stop(self, p):
+        """Stops watching. Returns the changes printed."""
+        if p.returncode is not None:
+            return ""
+        killpg(p.pid, signal.SIGTERM)
+        return p.communicate(timeout=5)[0].decode()
+
+    def _wait_for(self, predicate):
+        deadline = time.time() + 3
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(predicate())
+
+    def test_watch_refreshes_caches(self):
+        """
+        wb watch --poll
+        Refreshes the index, removes composed workbenches and rebuilds
+        bundles of the benches affected by a change
+        """
+        o = run("WORKBENCH_HOME={home} WORKBENCH_COMPOSE_CACHE=1 "
+                "{wb} r b true && WORKBENCH_HOME={home} {wb} compile team/a",
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.returncode, 0)
+        bundle = join("bundle", "team", "a.bundle")
+        self.assertIn("# team\n", self._read(bundle))
+        p = self._start()
+
+        self._write("team/wb.shelf", "# changed\n")
+        self._wait_for(lambda: "# changed\n" in self._read(bundle))
+        self._write("team/c.bench", "# c\n")
+        remove(join(self.test_dir, "b.bench"))
+        #   Changes are recorded once the caches are refreshed
+        self._wait_for(lambda: "c.bench" in self._read("changes") and
+                       "b.bench" in self._read("changes"))
+        self.assertEqual(sorted(self._read("index.bench").split()),
+                         ["team/a", "team/c"])
+        self.assertFalse(exists(join(self.cache_dir, "compose", "b.r")))
+        changes = self._read("changes").split("\n")
+        self.assertTrue(changes[0].startswith("#wbchanges "))
+        self.assertEqual(sorted(l.split("\t")[1] for l in changes[1:] if l),
+                         [join(self.test_dir, "b.bench"),
+                          join(self.test_dir, "team", "c.bench"),
+                          join(self.test_dir, "team", "wb.shelf")])
+
+        changes = self._stop(p).split("\n")
+        self.assertEqual(changes[0], "M team/wb.shelf")
+        self.assertEqual(sorted(changes[1:]),
+                         ["", "A team/c.bench", "D b.bench"])
+        self.assertEqual([f for f in listdir(self.cache_dir)
+                          if f.startswith("watch.")], [])
+
+    def test_watch_mirror(self):
+        """
+        WORKBENCH_MIRROR=<dir> wb watch --poll
+        Watches WORKBENCH_HOME, and syncs the mirror before refreshing the
+        caches in it
+        """
+        mirror = join(self.tmp_dir, "mirror")
+        self.cache_dir = join(mirror, ".wbcache")
+        env = "WORKBENCH_MIRROR={} WORKBENCH_MIRROR_INTERVAL=3600" \
+            .format(mirror)
+        o = run(env + " WORKBENCH_HOME={home} WORKBENCH_COMPOSE_CACHE=1 "
+                "{wb} r b true", replace=dict(home=self.test_dir))
+        self.assertEqual(o.returncode, 0, o.stderr)
+        self.assertTrue(exists(join(self.cache_dir, "compose", "b.r")))
+        p = self._start(env)
+
+        self._write("b.bench", "echo changed\n")
+        self._wait_for(lambda: not exists(join(self.cache_dir, "compose",
+                                               "b.r")))
+        with open(join(mirror, "b.bench")) as f:
+            self.assertEqual(f.read(), "echo changed\n")
+        o = run(env + " WORKBENCH_HOME={home} {wb} r b true",
+                replace=dict(home=self.test_dir))
+        self.assertEqual((o.returncode, o.stdout), (0, "changed\n"))
+        self.assertEqual(self._stop(p), "M b.bench\n")
+
+    def test_watch_chain_changed(self):
+        """
+        workbench_chain_changed
+        Reports the files in the chain of an activated workbench which
+        'wb watch' saw change since activation
+        """
+        self._write("team/a.bench", "\n".join([
+            'workbench_OnActivate () {',
+            '    workbench_chain_changed || echo "none"',
+            '    echo "# edit" >> "{}"'.format(
+                join(self.test_dir, "team", "wb.shelf")),
+            '    for i in {1..50}; do',
+            '        workbench_chain_changed && return',
+            '        sleep 0.1',
+            '    done',
+            '}', '']))
+        self._start()
+        o = run("WORKBENCH_HOME={home} WORKBENCH_ACTIVATE_CMD={executor} "
+                "{wb} a team/a",
+                replace=dict(home=self.test_dir, executor=EXECUTOR))
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.stdout, "none\n{}\n".format(
+            join(self.test_dir, "team", "wb.shelf")))
+
+    def test_watch_invalid_interval(self):
+        """
+        wb watch --interval <seconds>
+        Must fail on an interval which isn't a number
+        """
+        o = run("WORKBENCH_HOME={home} {wb} watch -i 1s",
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.returncode, 4)
+
+
+class TestWbSymbol(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "team", "x"))
+        self._write("wb.shelf", "\n".join([
+            'export ROOT=1 OTHER="a b"',
+            'greet () { echo root; }',
+            'LEVEL=root', '']))
+        self._write("team/wb.shelf", "\n".join([
+            'function greet {',
+            '    LEVEL=ignored',
+            '}',
+            'declare -x TEAM=1',
+            'LEVEL+=team', '']))
+        self._write("team/x/a.bench", "greet() { :; }\n")
+        self._write("team/b.bench", "")
+
+    def _symbol(self, args, returncode=0):
+        o = self.wb("symbol " + args)
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.returncode, returncode)
+        return o.stdout.replace(self.test_dir + "/", "").split("\n")[:-1]
+
+    def test_symbol_definitions(self):
+        """
+        wb symbol <name>
+        Lists every definition of a function or variable, by path
+        """
+        self.assertEqual(self._symbol("greet"), [
+            "team/wb.shelf:1: function greet",
+            "team/x/a.bench:1: function greet",
+            "wb.shelf:2: function greet"])
+        self.assertEqual(self._symbol("OTHER"), ["wb.shelf:1: export OTHER"])
+        self.assertEqual(self._symbol("TEAM"),
+                         ["team/wb.shelf:4: export TEAM"])
+        self.assertEqual(self._symbol("LEVEL"), [
+            "team/wb.shelf:5: variable LEVEL",
+            "wb.shelf:3: variable LEVEL"])
+        self.assertEqual(self._symbol("nonexistent", 3), [])
+
+    def test_symbol_chain(self):
+        """
+        wb symbol <name> <benchName>
+        Lists the definitions in the chain of a bench, in source order
+        """
+        self.assertEqual(self._symbol("greet team/x/a"), [
+            "wb.shelf:2: function greet",
+            "team/wb.shelf:1: function greet",
+            "team/x/a.bench:1: function greet"])
+        self.assertEqual(self._symbol("greet team/b"), [
+            "wb.shelf:2: function greet",
+            "team/wb.shelf:1: function greet"])
+        self.assertEqual(self._symbol("ROOT team/b"),
+                         ["wb.shelf:1: export ROOT"])
+        o = run("WORKBENCH_HOME={home} {wb} symbol greet team/nonexistent",
+                replace=dict(home=self.test_dir))
+        self.assertEqual(o.returncode, 3)
+
+    def test_symbol_refresh(self):
+        """
+        wb symbol <name>
+        Reads files which changed since the last lookup again
+        """
+        self._symbol("greet")
+        self._write("team/b.bench", "greet () { :; }\n")
+        remove(join(self.test_dir, "team", "x", "a.bench"))
+        self.assertEqual(self._symbol("greet"), [
+            "team/b.bench:1: function greet",
+            "team/wb.shelf:1: function greet",
+            "wb.shelf:2: function greet"])
+
+
+class TestWbMirror(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        #   The remote home is stood in for by a local directory
+        self.test_dir = join(self.tmp_dir, "remote")
+        self.mirror_dir = join(self.tmp_dir, "mirror")
+        makedirs(join(self.test_dir, "team"))
+        self._write("wb.shelf", "export ROOT=1\n")
+        self._write("team/a.bench", "export A=1\n")
+        self._write("team/b.bench", "export B=1\n")
+
+    @property
+    def wb_env(self):
+        #   Tests move the mirror
+        return dict(WORKBENCH_MIRROR=self.mirror_dir,
+                    WORKBENCH_MIRROR_INTERVAL="")
+
+    def test_mirror_serves_local(self):
+        """
+        WORKBENCH_MIRROR=<dir>
+        Lists, composes and sources from the mirror
+        """
+        o = self.wb("b")
+        self.assertEqual((o.returncode, o.stdout), (0, "team/a\nteam/b\n"))
+        o = self.wb("r team/a echo \\$WORKBENCH_CHAIN")
+        self.assertEqual(o.returncode, 0)
+        self.assertEqual(o.stdout, "{0}/wb.shelf:{0}/team/a.bench\n"
+                                   .format(self.mirror_dir))
+        o = self.wb("b team/a")
+        self.assertEqual(o.stdout, join(self.test_dir, "team", "a.bench\n"))
+
+    def test_mirror_interval(self):
+        """
+        WORKBENCH_MIRROR_INTERVAL=<seconds>
+        The mirror is validated only once the interval has passed
+        """
+        self.assertEqual(self.wb("b").returncode, 0)
+        self._write("team/a.bench", "export A=2\n")
+        remove(join(self.test_dir, "team", "b.bench"))
+        o = self.wb("r team/a echo \\$A")
+        self.assertEqual(o.stdout, "1\n")
+        o = self.wb("r team/a echo \\$A", WORKBENCH_MIRROR_INTERVAL="0")
+        self.assertEqual(o.stdout, "2\n")
+        self.assertEqual(self.wb("b").stdout, "team/a\n")
+        self.assertFalse(exists(join(self.mirror_dir, "team", "b.bench")))
+
+    def test_mirror_new_bench(self):
+        """
+        wb n <benchName>
+        Creates the bench in WORKBENCH_HOME, and expires the mirror
+        """
+        self.assertEqual(self.wb("b").stdout, "team/a\nteam/b\n")
+        self.assertEqual(self.wb("n team/c").returncode, 0)
+        self.assertTrue(exists(join(self.test_dir, "team", "c.bench")))
+        self.assertEqual(self.wb("b").stdout,
+                         "team/a\nteam/b\nteam/c\n")
+
+    def test_mirror_links(self):
+        """
+        Links are mirrored as links. The realpath checks apply.
+        """
+        symlink(join(self.test_dir, "team", "a.bench"),
+                join(self.test_dir, "abs.bench"))
+        symlink(join(self.tmp_dir, "outside.bench"),
+                join(self.test_dir, "out.bench"))
+        with open(join(self.tmp_dir, "outside.bench"), "w") as f:
+            f.write("echo OUTSIDE\n")
+        o = self.wb("r abs echo \\$A")
+        self.assertEqual((o.returncode, o.stdout), (0, "1\n"))
+        o = self.wb("r out true")
+        self.assertEqual(o.returncode, 4)
+        self.assertIn("lies outside '{}'".format(self.mirror_dir), o.stderr)
+
+    def test_mirror_skips_cache(self):
+        """
+        WORKBENCH_CACHE_DIR isn't mirrored, nor is the path in the home
+        which would be copied over it
+        """
+        makedirs(join(self.test_dir, ".wbcache", "compose"))
+        self._write(".wbcache/compose/planted", "echo planted\n")
+        o = self.wb("b")
+        self.assertEqual(o.returncode, 0, o.stderr)
+        self.assertTrue(exists(join(self.mirror_dir, ".wbcache", "mirror")))
+        self.assertFalse(exists(join(self.mirror_dir, ".wbcache",
+                                     "compose", "planted")))
+
+        self.mirror_dir = join(self.tmp_dir, "mirror2")
+        o = self.wb("b", WORKBENCH_CACHE_DIR=join(self.test_dir, "cache"))
+        self.assertEqual(o.returncode, 0, o.stderr)
+        self.assertTrue(exists(join(self.test_dir, "cache", "mirror")))
+        self.assertFalse(exists(join(self.mirror_dir, "cache")))
+
+    def test_mirror_overlaps_home(self):
+        """
+        WORKBENCH_MIRROR must not be inside WORKBENCH_HOME
+        """
+        self.mirror_dir = join(self.test_dir, "mirror")
+        self.assertEqual(self.wb("b").returncode, 4)
+
+
+@unittest.skipUnless(DASH, "dash is not installed")
+class TestWbPosix(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "team"))
+        makedirs(join(self.test_dir, "lib"))
+        self._write("wb.shelf",
+                    "ROOT=1\n"
+                    "workbench_autoload lib/tools.sh greet missing\n")
+        self._write("lib/tools.sh", 'greet () { echo "hi $*"; }\n')
+        self._write("team/a.bench",
+                    "echo sourced\n"
+                    'workbench_OnRun () { echo "$#"; "$@"; }\n')
+
+    @property
+    def wb_env(self):
+        #   DASH is only known to be set once the test runs
+        return dict(WORKBENCH_POSIX="1", WORKBENCH_POSIX_CMD=DASH + " -c")
+
+    def test_posix_dump_is_posix(self):
+        """
+        WORKBENCH_POSIX=1 wb r --dump <benchName>
+        Composes a workbench which dash parses
+        """
+        o = self.wb("r --dump team/a true")
+        self.assertEqual(o.returncode, 0)
+        self.assertIn("(POSIX sh)", o.stdout)
+        check = subprocess.run([DASH, "-n"], input=o.stdout,
+                               universal_newlines=True,
+                               stderr=subprocess.PIPE)
+        self.assertEqual((check.returncode, check.stderr), (0, ""))
+        for bashism in ("[[", "builtin ", "source ", "declare ", "local "):
+            self.assertNotIn(bashism, o.stdout)
+
+    def test_posix_run(self):
+        """
+        WORKBENCH_POSIX=1 wb r <benchName> [[arg]..]
+        Runs the workbench under WORKBENCH_POSIX_CMD
+        """
+        o = self.wb("r team/a sh -c 'echo $WORKBENCH_CHAIN; exit 7' 'a b'")
+        self.assertEqual(o.returncode, 7)
+        self.assertEqual(o.stdout, "sourced\n4\n{0}/wb.shelf:"
+                         "{0}/team/a.bench\n".format(self.test_dir))
+        for env in ("WORKBENCH_EXEC_FD", "WORKBENCH_COMPOSE_CACHE"):
+            with self.subTest(env=env):
+                o = self.wb("r team/a greet 'a  b'", **{env: "1"})
+                self.assertEqual((o.returncode, o.stdout),
+                                 (0, "sourced\n2\nhi a  b\n"))
+
+    def test_posix_autoload(self):
+        """
+        workbench_autoload works in a POSIX workbench
+        """
+        o = self.wb("r team/a greet there")
+        self.assertEqual(o.stdout, "sourced\n2\nhi there\n")
+        o = self.wb("r team/a missing")
+        self.assertEqual(o.returncode, 127)
+        self.assertIn("Function 'missing' is not defined in '{}'".format(
+                      join(self.test_dir, "lib", "tools.sh")), o.stderr)
+
+    def test_posix_new(self):
+        """
+        WORKBENCH_POSIX=1 wb n <benchName>
+        """
+        self.assertEqual(self.wb("n team/b").returncode, 0)
+        self.assertTrue(exists(join(self.test_dir, "team", "b.bench")))
+
+
+class TestWbWarm(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sourced = join(self.tmp_dir, "sourced")
+        self.warm_dir = join(self.test_dir, ".wbcache", "warm", "team", "a")
+        makedirs(join(self.test_dir, "team"))
+        self._write_bench("hello")
+        self.addCleanup(self._stop_servers)
+
+    def _write_bench(self, greeting):
+        with open(join(self.test_dir, "team", "a.bench"), "w") as f:
+            f.write("echo $BASHPID >> {}\nexport GREETING={}\n"
+                    .format(self.sourced, greeting))
+
+    wb_env = dict(WORKBENCH_WARM_TIMEOUT="")
+
+    def _server_pid(self):
+        if not exists(join(self.warm_dir, "server")):
+            return None
+        with open(join(self.warm_dir, "server")) as f:
+            return int(f.readline())
+
+    def _sourced(self):
+        with open(self.sourced) as f:
+            return f.read().split()
+
+    def _stop_servers(self):
+        if not exists(self.sourced):
+            return
+        for pid in self._sourced():
+            try:
+                kill(int(pid), signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def test_warm_reuses_server(self):
+        """
+        wb r --warm <benchName> [[arg]..]
+        Returns the stdout, stderr and exitCode, and sources the chain once
+        """
+        o = self.wb("r --warm team/a bash -c "
+                    "'echo $GREETING; echo oops >&2; exit 3'")
+        self.assertEqual((o.returncode, o.stdout, o.stderr),
+                         (3, "hello\n", "oops\n"))
+        pid = self._server_pid()
+        o = self.wb("r --warm team/a pwd")
+        self.assertEqual((o.returncode, o.stdout), (0, WB_DIR + "\n"))
+        self.assertEqual(self._server_pid(), pid)
+        self.assertEqual(self._sourced(), [str(pid)])
+
+    def test_warm_restarts_on_change(self):
+        """
+        A change to a file in the chain starts a new server
+        """
+        o = self.wb("r --warm team/a printenv GREETING")
+        self.assertEqual(o.stdout, "hello\n")
+        pid = self._server_pid()
+        self._write_bench("again")
+        utime(join(self.test_dir, "team", "a.bench"), (1, 1))
+        o = self.wb("r --warm team/a printenv GREETING")
+        self.assertEqual(o.stdout, "again\n")
+        self.assertNotEqual(self._server_pid(), pid)
+        self.assertEqual(len(self._sourced()), 2)
+
+    def test_warm_follows_environment(self):
+        """
+        Commands run with the exported environment of the client. A
+        change to it starts a new server.
+        """
+        o = self.wb("r --warm team/a printenv FOO")
+        self.assertEqual((o.returncode, o.stdout), (1, ""))
+        pid = self._server_pid()
+        for value in ["first", "second", "second"]:
+            o = self.wb("r --warm team/a printenv FOO GREETING", FOO=value)
+            self.assertEqual(o.stdout, value + "\nhello\n")
+        self.assertNotEqual(self._server_pid(), pid)
+        self.assertEqual(len(self._sourced()), 3)
+
+    def test_warm_idle_timeout(self):
+        """
+        WORKBENCH_WARM_TIMEOUT=<seconds>
+        The server exits once idle for that long
+        """
+        o = self.wb("r --warm team/a true", WORKBENCH_WARM_TIMEOUT="1")
+        self.assertEqual(o.returncode, 0)
+        self.assertIsNotNone(self._server_pid())
+        deadline = time.monotonic() + 4
+        while self._server_pid() is not None and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.assertIsNone(self._server_pid())
+        self.assertFalse(exists(join(self.warm_dir, "in")))
+
+    def test_warm_errors(self):
+        """
+        --warm applies to 'r' only, and the timeout must be a number
+        """
+        self.assertEqual(self.wb("a --warm team/a").returncode, ERR_INVALID)
+        o = self.wb("r --warm team/a true", WORKBENCH_WARM_TIMEOUT="soon")
+        self.assertEqual(o.returncode, ERR_INVALID)
+
+
+class TestWbForkBudget(WbTestCase):
+    """
+    Counts the external commands started by the hot paths, and fails when
+    one exceeds its budget. Every executable on PATH is shadowed by a shim
+    which logs its name, and then execs the real one. Builtins, subshells
+    and commands run by absolute path, like the executor, aren't counted.
+
+    When a change needs another process, raise its budget here, along
+    with the reason.
+    """
+
+    BUDGETS = {
+        #   find + sort to list, realpath to probe, and resolve HOME
+        "b": 4,
+        #   realpath to probe, resolve HOME and the chain, cat for code
+        "a --dump outer/inner/simple1": 5,
+        #   as for 'a', + mktemp and chmod of the temp file, rm on exit
+        "r outer/inner/simple1 true": 7,
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.shim_dir = tempfile.mkdtemp(prefix="wb_shims_")
+        seen = set()
+        for d in get_exec_path():
+            if not isdir(d):
+                continue
+            for name in sorted(listdir(d)):
+                path = join(d, name)
+                if name in seen or isdir(path) or \
+                   not access(path, X_OK):
+                    continue
+                seen.add(name)
+                shim = join(cls.shim_dir, name)
+                with open(shim, "w") as f:
+                    f.write("#!/bin/sh\n"
+                            "echo '{}' >> \"$WB_FORK_LOG\"\n"
+                            "exec '{}' \"$@\"\n".format(name, path))
+                chmod(shim, 0o755)
+        cls.executor = shutil.which(EXECUTOR)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.shim_dir)
+
+    def _commands(self, args):
+        log = join(self.tmp_dir, "forks")
+        if exists(log):
+            remove(log)
+        o = run("PATH={shims} WB_FORK_LOG={log} "
+                "WORKBENCH_HOME={td}/wbhome/simple {executor} {wbfile} " + args,
+                replace=dict(shims=self.shim_dir, log=log, wbfile=WB,
+                             executor=self.executor))
+        self.assertEqual(o.returncode, 0, o.stderr)
+        if not exists(log):
+            return []
+        with open(log) as f:
+            return f.read().split()
+
+    def test_budgets(self):
+        """
+        The hot paths start no more external commands than budgeted
+        """
+        for args, budget in self.BUDGETS.items():
+            with self.subTest(args=args):
+                commands = self._commands(args)
+                self.assertLessEqual(
+                    len(commands), budget,
+                    "'wb {}' started {} commands: {}".format(
+                        args, len(commands), " ".join(commands)))
+
+    def test_shims_count(self):
+        """
+        The shims see the commands started by wb
+        """
+        self.assertIn("find", self._commands("b"))
+
+
+class TestWbResolve(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name in ["org/team/service/region/env",
+                     "org/team/service/region/prod",
+                     "org/team/svc2/region/env", "org/other/only",
+                     "org/test"]:
+            path = get_bench_filename(self.test_dir, name)
+            makedirs(dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write("export NAME={}\n".format(name))
+
+    wb_env = dict(WORKBENCH_RESOLVE="1")
+
+    def test_resolve_prefix(self):
+        """
+        WORKBENCH_RESOLVE=1 wb r <prefix> [[arg]..]
+        A unique prefix of each segment resolves to the bench
+        """
+        for name in ["org/team/se/r/p", "o/t/se/re/prod", "org/tes"]:
+            o = self.wb("r {} echo \\$NAME".format(name))
+            self.assertEqual(o.returncode, 0, name)
+        self.assertEqual(self.wb("r org/tes echo \\$NAME").stdout,
+                         "org/test\n")
+        o = self.wb("b org/team/se/r/e")
+        self.assertEqual(o.stdout, get_bench_filename(
+            self.test_dir, "org/team/service/region/env") + "\n")
+
+    def test_resolve_descends(self):
+        """
+        A prefix matching a single directory resolves to its only bench
+        """
+        o = self.wb("a --dump org/oth")
+        self.assertEqual(o.returncode, 0)
+        self.assertIn("org/other/only.bench", o.stdout)
+        self.assertEqual(self.wb("r org/o echo \\$NAME").stdout,
+                         "org/other/only\n")
+
+    def test_resolve_fuzzy(self):
+        """
+        Segments which aren't prefixes match as subsequences
+        """
+        o = self.wb("r o/tm/svc/rgn/prd echo \\$NAME")
+        self.assertEqual((o.returncode, o.stdout),
+                         (0, "org/team/service/region/prod\n"))
+
+    def test_resolve_ambiguous(self):
+        """
+        Candidates are listed, shortest first, with ERR_MISSING
+        """
+        o = self.wb("r org/t true")
+        self.assertEqual(o.returncode, 3)
+        self.assertEqual(o.stderr.splitlines()[1:],
+                         ["    org/test", "    org/team/"])
+        o = self.wb("b org/team/s/r/env")
+        self.assertEqual(o.returncode, 3)
+        self.assertEqual(o.stdout, "")
+        self.assertEqual(o.stderr.splitlines()[1:],
+                         ["    org/team/svc2/region/env",
+                          "    org/team/service/region/env"])
+
+    def test_resolve_command_by_prefix(self):
+        """
+        wb b -y <abbrev> rm
+        A command on a bench resolves its name by unique prefix only
+        """
+        prod = get_bench_filename(self.test_dir,
+                                  "org/team/service/region/prod")
+        o = self.wb("b -y o/tm/svc/rgn/prd rm")
+        self.assertEqual(o.returncode, 3)
+        self.assertTrue(exists(prod))
+        o = self.wb("b -y org/t rm")
+        self.assertEqual(o.returncode, 3)
+        self.assertIn("ambiguous", o.stderr)
+        self.assertTrue(exists(get_bench_filename(self.test_dir, "org/test")))
+        o = self.wb("b o/tm/svc/rgn/prd")
+        self.assertEqual((o.returncode, o.stdout), (0, prod + "\n"))
+        o = self.wb("b -y org/team/se/r/p rm")
+        self.assertEqual(o.returncode, 0)
+        self.assertFalse(exists(prod))
+
+    def test_resolve_exit_codes(self):
+        """
+        Names which match nothing, or are invalid, fail as before. Nothing
+        resolves unless WORKBENCH_RESOLVE is set, nor for 'n' and 'b -n'.
+        """
+        self.assertEqual(self.wb("r zzz true").returncode, 3)
+        self.assertEqual(self.wb("b zzz").returncode, 3)
+        self.assertEqual(self.wb("r org/tes/ true").returncode, 4)
+        o = self.wb("r org/tes true", WORKBENCH_RESOLVE="")
+        self.assertEqual(o.returncode, 3)
+        self.assertEqual(self.wb("n org/tes").returncode, 0)
+        self.assertTrue(exists(get_bench_filename(self.test_dir, "org/tes")))
+        self.assertEqual(self.wb("b -n org/oth touch").returncode, 0)
+        self.assertTrue(exists(get_bench_filename(self.test_dir, "org/oth")))
+
+
+class TestWbCompile(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        makedirs(join(self.test_dir, "outer"))
+        self._write("wb.shelf", "echo ROOT\n")
+        self._write("outer/wb.shelf", "echo OUTER")       # no newline
+        self._write("outer/one.bench", "echo ONE\n")
+        self.bundle = join(self.test_dir, ".wbcache", "bundle", "outer",
+                           "one.bundle")
+
+    wb_env = dict(WORKBENCH_ENV_NAME="")
+
+    def test_compile_all_benches(self):
+        """
+        wb compile
+        Writes a bundle per bench with source markers for each file
+        """
+        o = self.wb("compile")
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.returncode, 0)
+        self.assertEqual(o.stdout.strip(), self.bundle)
+        with open(self.bundle) as f:
+            lines = f.read().split('\n')
+        self.assertTrue(lines[0].startswith("# fingerprint "))
+        self.assertTrue(lines[1].startswith("# content-hash "))
+        shelf = join(self.test_dir, "outer", "wb.shelf")
+        self.assertEqual(lines[5:8], ["# >>> " + shelf, "echo OUTER",
+                                      "# <<< " + shelf])
+
+    def test_run_from_bundle(self):
+        """
+        wb a|r|n source the bundle of a compiled bench
+        """
+        self.wb("compile outer/one")
+        o = self.wb("r --dump outer/one")
+        self.assertIn('source "{}"'.format(self.bundle), o.stdout)
+        self.assertEqual(o.stdout.count("source "), 1)
+        o = self.wb("r outer/one")
+        self.assertEqual(o.stderr, "")
+        self.assertEqual(o.returncode, 0)
+        self.assertEqual(o.stdout.split('\n'), ["ROOT", "OUTER", "ONE", ""])
+
+    def test_stale_bundle_is_detected_and_rebuilt(self):
+        """
+        wb compile --check
+        Lists benches with stale bundles. 'wb r' rebuilds them.
+        """
+        self.wb("compile")
+        o = self.wb("compile --check")
+        self.assertEqual(o.stdout, "")
+        self.assertEqual(o.returncode, 0)
+
+        self._write("outer/one.bench", "echo TWO\n", mode="a")
+        o = self.wb("compile --check")
+        self.assertEqual(o.stdout.strip(), "outer/one")
+        self.assertEqual(o.returncode, ERR_INVALID)
+
+        o = self.wb("r outer/one")
+        self.assertEqual(o.stdout.split('\n'),
+                         ["ROOT", "OUTER", "ONE", "TWO", ""])
+        o = self.wb("compile --check")
+        self.assertEqual(o.returncode, 0)
+
+
+class TestWbExport(WbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.export_dir = join(self.tmp_dir, "export")
+        makedirs(join(self.test_dir, "team"))
+        makedirs(join(self.test_dir, "other"))
+        self._write("wb.shelf", "export ROOT=1\n")
+        self._write("team/wb.shelf", "export TEAM=1\n")
+        self._write("team/a.bench", "export A=1\n")
+        self._write("team/b.bench", "export B=1\n")
+        self._write("other/c.bench", "export A=1\n")  # same as team/a
+
+    def _run(self, args, export_dir=None):
+        #   Without WORKBENCH_HOME, and with `wb` nowhere to be found
+        return run("{run} " + args, replace=dict(
+            run=join(export_dir or self.export_dir, "run")))
+
+    def test_export_directory(self):
+        """
+        wb export -o <dir> [[selector]..]
+        Stores each file once under its hash, with a chain per bench
+        """
+        o = self.wb("export -o {}".format(self.export_dir))
+        self.assertEqual((o.returncode, o.stderr), (0, ""))
+        self.assertEqual(o.stdout, self.export_dir + "\n")
+        self.assertEqual(len(listdir(join(self.export_dir, "objects"))), 4)
+        with open(join(self.export_dir, "benches", "team", "a.chain")) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], "#wbexport 1 team/a")
+        self.assertEqual([l.split(" ", 1)[1] for l in lines[1:]],
+                         ["wb.shelf", "team/wb.shelf", "team/a.bench"])
+        for line in lines[1:]:
+            name = join(self.export_dir, "objects", line.split(" ")[0])
+            self.assertTrue(exists(name))
+
+    def test_export_run(self):
+        """
+        <export>/run <a|r> <benchName> [[arg]..]
+        Runs an exported bench without WorkBench or WORKBENCH_HOME
+        """
+        self.wb("export -o {} team/".format(self.export_dir))
+        shutil.rmtree(self.test_dir)
+        o = self._run("r team/b echo \\$ROOT \\$TEAM \\$B "
+                      "\\$WORKBENCH_ENV_NAME")
+        self.assertEqual((o.returncode, o.stdout), (0, "1 1 1 team/b\n"))
+        o = self._run("r team/a sh -c 'exit 7'")
+        self.assertEqual(o.returncode, 7)
+        self.assertEqual(self._run("r other/c true").returncode, 3)
+        self.assertEqual(self._run("r ../team/a true").returncode, 4)
+        self.assertEqual(self._run("x team/a").returncode, 4)
+
+    def test_export_autoload(self):
+        """
+        Files which the chain autoloads are exported too. An autoload
+        which can't be resolved fails the export.
+        """
+        makedirs(join(self.test_dir, "lib"))
+        self._write("lib/tools.sh", "workbench_autoload lib/more.sh extra\n"
+                                    'greet () { echo "hi $*"; extra; }\n')
+        self._write("lib/more.sh", "extra () { echo extra; }\n")
+        self._write("team/wb.shelf",
+                    "workbench_autoload 'lib/tools.sh' greet\n")
+        o = self.wb("export -o {} team/a".format(self.export_dir))
+        self.assertEqual((o.returncode, o.stderr), (0, ""))
+        self.assertEqual(len(listdir(join(self.export_dir, "objects"))), 3)
+        shutil.rmtree(self.test_dir)
+        o = self._run("r team/a greet a b")
+        self.assertEqual((o.returncode, o.stdout), (0, "hi a b\nextra\n"))
+
+        for line, rc in [('workbench_autoload "$LIB/x.sh" f', 4),
+                         ("workbench_autoload /etc/profile f", 4),
+                         ("workbench_autoload ../outside.sh f", 4),
+                         ("workbench_autoload lib/missing.sh f", 3)]:
+            with self.subTest(line=line):
+                export_dir = join(self.tmp_dir, "export2")
+                makedirs(join(self.test_dir, "team"), exist_ok=True)
+                self._write("wb.shelf", line + "\n")
+                self._write("team/a.bench", "\n")
+                with open(join(self.tmp_dir, "outside.sh"), "w") as f:
+                    f.write("f () { :; }\n")
+                o = self.wb("export -o {} team/a".format(export_dir))
+                self.assertEqual(o.returncode, rc)
+                self.assertIn("wb.shelf:1:", o.stderr)
+                self.assertFalse(exists(export_dir))
+
+    def test_export_tarball(self):
+        """
+        wb export -o <path>.tar.gz
+        """
+        tarball = join(self.tmp_dir, "export.tar.gz")
+        o = self.wb("export -o {} team/a".format(tarball))
+        self.assertEqual(o.returncode, 0)
+        makedirs(self.export_dir)
+        subprocess.run(["tar", "-xzf", tarball, "-C", self.export_dir],
+                       check=True)
+        self.assertEqual(listdir(join(self.export_dir, "benches", "team")),
+                         ["a.chain"])
+        o = self._run("r team/a echo \\$A")
+        self.assertEqual(o.stdout, "1\n")
+
+    def test_export_errors(self):
+        """
+        The output must be given and must not exist. Every selector must
+        match a bench.
+        """
+        self.assertEqual(self.wb("export").returncode, 4)
+        self.assertEqual(self.wb("export -o").returncode, 4)
+        o = self.wb("export -o {} team/x".format(self.export_dir))
+        self.assertEqual(o.returncode, 3)
+        makedirs(self.export_dir)
+        o = self.wb("export -o {} team/a".format(self.export_dir))
+        self.assertEqual(o.returncode, 6)
+        self.assertEqual(listdir(self.export_dir), [])
+        self.assertEqual(sorted(listdir(self.tmp_dir)),
+                         ["export", "home", "wbhome"])
+
+
 # -----------------------------------------------------------------------------
 #
 
+#
+#   Parallel runner
+#
+#   tests/test_wb.py --jobs <N> [--slowest <M>]
+#
+#   Runs every test in its own task on a pool of <N> worker processes; all
+#   cores if <N> is 0. Prints the duration and outcome of each test as it
+#   completes, followed by the <M> slowest tests.
+#
+
+def _test_ids(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from _test_ids(test)
+        else:
+            yield test.id().split(".", 1)[1]
+
+
+def _run_test(test_id):
+    suite = unittest.defaultTestLoader.loadTestsFromName(
+        test_id, sys.modules[__name__])
+    result = unittest.TestResult()
+    start = time.monotonic()
+    suite.run(result)
+    duration = time.monotonic() - start
+    outcome, details = "ok", ""
+    if result.skipped:
+        outcome = "skip"
+    for kind, errors in [("FAIL", result.failures), ("ERROR", result.errors)]:
+        for _, traceback in errors:
+            outcome, details = kind, details + traceback
+    return test_id, duration, outcome, details
+
+
+def run_parallel(jobs, slowest):
+    suite = unittest.defaultTestLoader.loadTestsFromModule(
+        sys.modules[__name__])
+    test_ids = list(_test_ids(suite))
+    jobs = jobs or multiprocessing.cpu_count()
+    start = time.monotonic()
+    results = []
+    with multiprocessing.Pool(jobs) as pool:
+        for r in pool.imap_unordered(_run_test, test_ids):
+            print("{:8.3f}s  {:5}  {}".format(r[1], r[2], r[0]), flush=True)
+            results.append(r)
+    duration = time.monotonic() - start
+
+    failed = [r for r in results if r[2] in ["FAIL", "ERROR"]]
+    for test_id, _, outcome, details in failed:
+        print("=" * 70)
+        print("{}: {}".format(outcome, test_id))
+        print("-" * 70)
+        print(details)
+    print("-" * 70)
+    print("Slowest tests:")
+    for test_id, seconds, _, _ in sorted(results, key=lambda r: -r[1])[:slowest]:
+        print("{:8.3f}s  {}".format(seconds, test_id))
+    print("-" * 70)
+    print("Ran {} tests in {:.3f}s on {} processes".format(
+        len(results), duration, jobs))
+    print("FAILED (failures={})".format(len(failed)) if failed else "OK")
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
+    if "-j" in sys.argv or "--jobs" in sys.argv:
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-j", "--jobs", type=int, default=0)
+        parser.add_argument("--slowest", type=int, default=10)
+        args = parser.parse_args()
+        sys.exit(run_parallel(args.jobs, args.slowest))
     unittest.main()